@@ -0,0 +1,92 @@
+"""
+Helpers for the JSON API under /api/v1.
+
+The API views in app.py are async so that a view needing several independent
+lookups (an item and the user's offers for it, a profile's listings and its
+counters) can start them all at once with gather() and wait for the slowest
+instead of their sum. The lookups themselves use the app's pymongo client on
+a small shared thread pool, so they go through the same connection pools,
+read preferences and metrics as the HTML pages. Async views need Flask's async
+extra (the asgiref package).
+
+Responses only carry the fields a client needs, with ids, prices and dates as
+strings.
+"""
+
+import asyncio
+import contextvars
+import datetime
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import flask_login
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from flask import jsonify
+
+API_PREFIX = "/api/v1"
+# lookups running at once for the API views of a worker
+_executor = ThreadPoolExecutor(
+    int(os.getenv("API_LOOKUP_THREADS", "8")), thread_name_prefix="api"
+)
+
+
+async def gather(*calls):
+    """
+    Runs blocking calls (functions taking no arguments) at the same time and
+    returns their results in order
+    """
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(
+        *(
+            # in a copy of this context, so request metrics still count the commands
+            loop.run_in_executor(_executor, contextvars.copy_context().run, call)
+            for call in calls
+        )
+    )
+
+
+def to_json(value):
+    """
+    Turns a document into plain JSON types: ObjectIds and Decimal128 become
+    strings and datetimes ISO 8601 strings in UTC
+    """
+    if isinstance(value, dict):
+        return {
+            ("id" if key == "_id" else key): to_json(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, (ObjectId, Decimal128)):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat() + "Z" if value.tzinfo is None else value.isoformat()
+    return value
+
+
+def error(message, status):
+    return jsonify(error=message), status
+
+
+def login_required(view):
+    """
+    Like flask_login.login_required, but answers 401 with a JSON error instead
+    of redirecting to the login page
+    """
+
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        if not flask_login.current_user.is_authenticated:
+            return error("log in first", 401)
+        return await view(*args, **kwargs)
+
+    return wrapper
+
+
+def object_id(value):
+    """
+    Returns value as an ObjectId, or None if it is not a valid id
+    """
+    return ObjectId(value) if ObjectId.is_valid(value) else None
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Moves resolved offers and stale listings out of the live collections.
+
+Answered, withdrawn and expired offers and private listings are never shown on
+the feed or the offer pages again, but without this they would stay in offers
+and items forever and every query and index behind those pages would keep
+growing. archive_offers() moves offers resolved more than a given time ago to
+offers_archive, and archive_items() moves private listings nobody touched for
+a given time to items_archive, batch_size documents at a time: one find, one
+insert_many and one delete_many per batch. A batch that was copied but not
+deleted (the process died in between) is copied again on the next run and the
+duplicates are skipped.
+
+Archived offers keep a copy of their items, so history pages read one
+collection and still show offers whose items were archived or deleted since.
+Listings that still have pending offers are left in place. Both archives
+expire their documents retention days after they were archived through a TTL
+index on archived_at.
+
+Run this file to archive once with the defaults:
+
+    python archive.py --offer-days 30 --item-days 180
+"""
+
+import argparse
+import datetime
+import logging
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from database import start_periodic
+from offers import OFFER_ITEM_FIELDS
+from pagination import keyset_page
+from profiles import adjust
+from social import unpublish_items
+
+ARCHIVE_BATCH_SIZE = 500
+RESOLVED_STATUSES = ("accepted", "rejected", "withdrawn", "expired")
+DEFAULT_OFFER_DAYS = 30
+DEFAULT_ITEM_DAYS = 180
+# days archived documents are kept, 0 keeps them for good
+DEFAULT_RETENTION_DAYS = 730
+HISTORY_PAGE_SIZE = 20
+TTL_INDEX = "archived_at_ttl"
+DUPLICATE_KEY = 11000
+INDEX_OPTIONS_CONFLICT = 85
+
+log = logging.getLogger("campusswap.archive")
+
+
+def _older_than(field, cutoff):
+    # documents written before field was set fall back to the time in their _id
+    return {
+        "$or": [
+            {field: {"$lt": cutoff}},
+            {field: {"$exists": False}, "_id": {"$lt": ObjectId.from_datetime(cutoff)}},
+        ]
+    }
+
+
+def _copy(collection, docs):
+    # a batch copied before a crash is copied again, the duplicates are skipped
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+            raise
+
+
+def _batches(collection, query, batch_size, projection=None):
+    # the documents matching query in _id order, one list of batch_size at a time
+    last_id = None
+    while True:
+        batch_query = {"$and": [query, {"_id": {"$gt": last_id}}]} if last_id else query
+        batch = list(
+            collection.find(batch_query, projection).sort("_id", 1).limit(batch_size)
+        )
+        if not batch:
+            return
+        last_id = batch[-1]["_id"]
+        yield batch
+
+
+def _item_snapshots(db, offers):
+    # {item id string: item fields} of the items the offers point to, live or archived
+    item_ids = set()
+    for offer in offers:
+        item_ids.add(str(offer.get("offerforid")))
+        item_ids.update(str(item_id) for item_id in offer.get("offereditems", []))
+    valid = [ObjectId(item_id) for item_id in item_ids if ObjectId.is_valid(item_id)]
+    query = {"_id": {"$in": valid}}
+    projection = dict.fromkeys(OFFER_ITEM_FIELDS, 1)
+    snapshots = {}
+    for collection in (db.items, db.items_archive):
+        for item in collection.find(query, projection):
+            snapshots.setdefault(str(item["_id"]), item)
+    return snapshots
+
+
+def archive_offers(db, max_age, batch_size=ARCHIVE_BATCH_SIZE, query=None):
+    """
+    Moves the offers resolved more than max_age (a timedelta) ago to offers_archive,
+    with offerforid and offereditems replaced by copies of the items like
+    offers.hydrate_offers. query narrows down the offers considered.
+    Returns the number of offers moved.
+    """
+    now = datetime.datetime.utcnow()
+    query = {
+        "$and": [
+            {"status": {"$in": list(RESOLVED_STATUSES)}},
+            _older_than("updated_at", now - max_age),
+            query or {},
+        ]
+    }
+    moved = 0
+    for batch in _batches(db.offers, query, batch_size):
+        items = _item_snapshots(db, batch)
+        archived = []
+        for offer in batch:
+            offered = offer.get("offereditems", [])
+            archived.append(
+                dict(
+                    offer,
+                    offerforid=items.get(str(offer.get("offerforid"))),
+                    offereditems=[items.get(str(item_id)) for item_id in offered],
+                    archived_at=now,
+                )
+            )
+        _copy(db.offers_archive, archived)
+        ids = [offer["_id"] for offer in batch]
+        moved += db.offers.delete_many(
+            {"_id": {"$in": ids}, "status": {"$in": list(RESOLVED_STATUSES)}}
+        ).deleted_count
+    return moved
+
+
+def _pending_items(db, item_ids):
+    # the ids among item_ids (strings) that a pending offer wants or offers
+    busy = set()
+    for offer in db.offers.find(
+        {
+            "status": "sent",
+            "$or": [
+                {"offerforid": {"$in": item_ids}},
+                {"offereditems": {"$in": item_ids}},
+            ],
+        },
+        {"offerforid": 1, "offereditems": 1},
+    ):
+        busy.add(str(offer.get("offerforid")))
+        busy.update(str(item_id) for item_id in offer.get("offereditems", []))
+    return busy
+
+
+def archive_items(db, max_age, batch_size=ARCHIVE_BATCH_SIZE, query=None):
+    """
+    Moves the private listings not updated for max_age (a timedelta) to items_archive,
+    skipping those with pending offers, and updates their owners' counters.
+    query narrows down the listings considered. Returns the number of listings moved.
+    """
+    now = datetime.datetime.utcnow()
+    stale = {"public": {"$ne": True}}
+    query = {"$and": [stale, _older_than("updated_at", now - max_age), query or {}]}
+    moved = 0
+    for batch in _batches(db.items, query, batch_size):
+        busy = _pending_items(db, [str(item["_id"]) for item in batch])
+        batch = [item for item in batch if str(item["_id"]) not in busy]
+        if not batch:
+            continue
+        _copy(db.items_archive, [dict(item, archived_at=now) for item in batch])
+        ids = [item["_id"] for item in batch]
+        deleted = db.items.delete_many({"_id": {"$in": ids}, **stale}).deleted_count
+        if deleted != len(ids):
+            # made public in the meantime, that copy stays live
+            live = db.items.find({"_id": {"$in": ids}}, {"_id": 1})
+            kept = {item["_id"] for item in live}
+            db.items_archive.delete_many({"_id": {"$in": list(kept)}})
+            batch = [item for item in batch if item["_id"] not in kept]
+        unpublish_items(db, [item["_id"] for item in batch])
+        owners = {}
+        for item in batch:
+            if item.get("user"):
+                owners[item["user"]] = owners.get(item["user"], 0) + 1
+        for user_id, count in owners.items():
+            adjust(db, user_id, listings=-count)
+        moved += len(batch)
+    return moved
+
+
+def restore_item(db, item_id, user_id):
+    """
+    Moves an archived listing of user_id back to items, still private.
+    Returns the listing, or None if user_id has no such archived listing.
+    """
+    item = db.items_archive.find_one(
+        {"_id": ObjectId(item_id), "user": ObjectId(user_id)}
+    )
+    if item is None:
+        return None
+    item.pop("archived_at", None)
+    item["updated_at"] = datetime.datetime.utcnow()
+    try:
+        db.items.insert_one(item)
+    except DuplicateKeyError:
+        # restored by an earlier request that did not get to delete the copy
+        pass
+    else:
+        adjust(db, user_id, listings=1)
+    db.items_archive.delete_one({"_id": item["_id"]})
+    return item
+
+
+def offer_history(db, user_id, after=None, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Returns one pagination.Page of the archived offers user_id sent or received,
+    newest first
+    """
+    user_id = ObjectId(user_id)
+    return keyset_page(
+        db.offers_archive,
+        {"$or": [{"sentby": user_id}, {"sendtouser": user_id}]},
+        "_id",
+        -1,
+        after=after,
+        before=before,
+        limit=limit,
+    )
+
+
+def item_history(db, user_id, after=None, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Returns one pagination.Page of the archived listings of user_id, newest first
+    """
+    return keyset_page(
+        db.items_archive,
+        {"user": ObjectId(user_id)},
+        "created_at",
+        -1,
+        after=after,
+        before=before,
+        limit=limit,
+    )
+
+
+def ensure_retention(db, days):
+    """
+    Makes the archives expire their documents days after they were archived,
+    or keeps them for good if days is 0
+    """
+    for collection in (db.offers_archive, db.items_archive):
+        if not days:
+            if TTL_INDEX in collection.index_information():
+                collection.drop_index(TTL_INDEX)
+            continue
+        seconds = int(days * 24 * 60 * 60)
+        try:
+            collection.create_index(
+                [("archived_at", ASCENDING)], name=TTL_INDEX, expireAfterSeconds=seconds
+            )
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # the retention changed, update the index in place
+            db.command(
+                "collMod",
+                collection.name,
+                index={"name": TTL_INDEX, "expireAfterSeconds": seconds},
+            )
+
+
+def archive(db, offer_age, item_age, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Archives offers first, so the listings they point to are still found for the copies.
+    Returns (offers moved, listings moved).
+    """
+    return (
+        archive_offers(db, offer_age, batch_size),
+        archive_items(db, item_age, batch_size),
+    )
+
+
+def start_archiver(db, offer_age, item_age, retention_days, interval):
+    """
+    Sets the retention, then starts a daemon thread that archives every interval seconds
+    """
+    try:
+        ensure_retention(db, retention_days)
+    except Exception:
+        log.exception("setting the archive retention failed")
+    return start_periodic(
+        interval, lambda: archive(db, offer_age, item_age), log, "archiving"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive old offers and listings.")
+    parser.add_argument("--offer-days", type=float, default=DEFAULT_OFFER_DAYS)
+    parser.add_argument("--item-days", type=float, default=DEFAULT_ITEM_DAYS)
+    parser.add_argument("--retention-days", type=float, default=DEFAULT_RETENTION_DAYS)
+    args = parser.parse_args()
+
+    from app import db
+
+    ensure_retention(db, args.retention_days)
+    offers_moved, items_moved = archive(
+        db,
+        datetime.timedelta(days=args.offer_days),
+        datetime.timedelta(days=args.item_days),
+    )
+    print(" * Archived", offers_moved, "offers and", items_moved, "listings")
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Fingerprinted, pre-compressed static files.
+
+Run this file to build static/dist from the files in static/:
+
+    python assets.py
+
+Every file is copied to a name with a hash of its content in it (style.css
+becomes style.3f2a9c1e04b7.css), text files get .gz and .br siblings and PNG
+and JPEG images get a .webp version. manifest.json maps the original names to
+the built ones.
+
+With a manifest in place url_for("static", filename="style.css") returns the
+fingerprinted URL, and StaticFiles answers requests for static/dist itself,
+before Flask routes them, with the best encoding the browser accepts and a
+Cache-Control that lets browsers keep the file forever; a new build means new
+names. A front proxy can serve static/dist the same way. Without a manifest
+the original files are served by Flask as before.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import url_for
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import wrap_file
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST = "dist"
+MANIFEST = "manifest.json"
+HASH_LENGTH = 12
+COMPRESSIBLE = (".css", ".js", ".svg", ".txt")
+WEBP_SOURCES = (".png", ".jpg", ".jpeg")
+WEBP_QUALITY = 80
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# encodings StaticFiles can send, best first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def _fingerprint(name, data, extension=None):
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    return "%s.%s%s" % (stem, digest, extension or ext)
+
+
+def _write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _webp(data):
+    from PIL import Image
+
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as picture:
+        picture.save(output, "WEBP", quality=WEBP_QUALITY, method=6)
+    return output.getvalue()
+
+
+def build(static_dir=STATIC_DIR):
+    """
+    Rebuilds static_dir/dist and its manifest. Returns the manifest, which maps every
+    file name to {"path": fingerprinted name, "webp": fingerprinted WebP name or None}.
+    Brotli files are only written if the brotli package is installed.
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    dist = os.path.join(static_dir, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+    os.makedirs(dist)
+    manifest = {}
+    for name in sorted(os.listdir(static_dir)):
+        source = os.path.join(static_dir, name)
+        if not os.path.isfile(source) or name.startswith("."):
+            continue
+        with open(source, "rb") as f:
+            data = f.read()
+        entry = {"path": _fingerprint(name, data), "webp": None}
+        target = os.path.join(dist, entry["path"])
+        _write(target, data)
+        if name.lower().endswith(COMPRESSIBLE):
+            _write(target + ".gz", gzip.compress(data, 9, mtime=0))
+            if brotli:
+                _write(target + ".br", brotli.compress(data))
+        if name.lower().endswith(WEBP_SOURCES):
+            webp = _webp(data)
+            entry["webp"] = _fingerprint(name, webp, ".webp")
+            _write(os.path.join(dist, entry["webp"]), webp)
+        manifest[name] = entry
+    with open(os.path.join(dist, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_dir=STATIC_DIR):
+    """
+    Returns the manifest written by build(), or {} if the assets were not built
+    """
+    try:
+        with open(os.path.join(static_dir, DIST, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+class StaticFiles:
+    """
+    WSGI middleware that serves the built files under /static/dist/ without going
+    through Flask, choosing a pre-compressed variant from Accept-Encoding
+    """
+
+    def __init__(self, app, static_dir=STATIC_DIR, prefix="/static/dist/"):
+        self.app = app
+        self.dist = os.path.join(static_dir, DIST)
+        self.prefix = prefix
+
+    def _variant(self, path, accept_encoding):
+        # the best pre-compressed file the client accepts, else the file itself
+        accept = parse_accept_header(accept_encoding)
+        for encoding, suffix in ENCODINGS:
+            if accept.quality(encoding) > 0 and os.path.isfile(path + suffix):
+                return path + suffix, encoding
+        return path, None
+
+    def __call__(self, environ, start_response):
+        path_info = environ.get("PATH_INFO", "")
+        method = environ["REQUEST_METHOD"]
+        if not path_info.startswith(self.prefix) or method not in ("GET", "HEAD"):
+            return self.app(environ, start_response)
+        name = path_info[len(self.prefix) :]
+        path = os.path.join(self.dist, name)
+        if "/" in name or name.startswith(".") or not os.path.isfile(path):
+            return self.app(environ, start_response)
+
+        etag = '"%s"' % name
+        headers = [
+            ("Cache-Control", CACHE_CONTROL),
+            ("ETag", etag),
+            ("Vary", "Accept-Encoding"),
+        ]
+        if etag in environ.get("HTTP_IF_NONE_MATCH", ""):
+            start_response("304 Not Modified", headers)
+            return []
+
+        accept_encoding = environ.get("HTTP_ACCEPT_ENCODING", "")
+        variant, encoding = self._variant(path, accept_encoding)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+        headers += [
+            ("Content-Type", content_type),
+            ("Content-Length", str(os.path.getsize(variant))),
+        ]
+        if encoding:
+            headers.append(("Content-Encoding", encoding))
+        start_response("200 OK", headers)
+        if method == "HEAD":
+            return []
+        return wrap_file(environ, open(variant, "rb"))
+
+
+class Assets:
+    """
+    Points url_for("static", ...) at the fingerprinted files and serves them
+    """
+
+    def __init__(self, static_dir=STATIC_DIR):
+        self.static_dir = static_dir
+        self.manifest = load_manifest(static_dir)
+
+    def init_app(self, app):
+        app.url_defaults(self._url_defaults)
+        app.add_template_global(self.webp_url)
+        app.wsgi_app = StaticFiles(app.wsgi_app, self.static_dir)
+
+    def _url_defaults(self, endpoint, values):
+        if endpoint != "static":
+            return
+        entry = self.manifest.get(values.get("filename"))
+        if entry:
+            values["filename"] = DIST + "/" + entry["path"]
+
+    def webp_url(self, filename):
+        """
+        URL of the WebP version of a static image, or None if there is none
+        """
+        entry = self.manifest.get(filename)
+        if not entry or not entry["webp"]:
+            return None
+        return url_for("static", filename=DIST + "/" + entry["webp"])
+
+
+if __name__ == "__main__":
+    for name, entry in build().items():
+        print(" *", name, "->", ", ".join(filter(None, entry.values())))
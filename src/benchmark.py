@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+"""
+Seeds synthetic data and measures the latency of the busiest routes.
+
+seed fills a separate database (campusswap_benchmark unless --database says
+otherwise) with users, friend lists, items and offers at the chosen scale.
+run logs a set of the seeded users in, drives the routes below through the
+Flask test client from --concurrency threads and reports p50/p95/p99 latency,
+errors and throughput for each route. Nothing goes over the network, so the
+numbers measure the app and MongoDB, not a WSGI server.
+
+    python benchmark.py seed --items 100000
+    python benchmark.py run --concurrency 8 --save /tmp/100k.json
+    python benchmark.py run --concurrency 8 --compare /tmp/100k.json
+    python benchmark.py match --offers 100000
+
+--compare exits with status 1 when the p95 of a route is more than
+--tolerance (default 25%) above the baseline. Pass --mock to both seed and run
+in one process against mongomock instead of a MongoDB server; it needs
+`pip install mongomock` and does not support every aggregation operator, so
+its numbers are only useful to check that the harness itself works.
+
+match needs no database: it builds a matching.TradeGraph from --offers
+synthetic pending offers, times a full match, then times adding offers one by
+one as the app does when they are made.
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+BENCHMARK_DATABASE = "campusswap_benchmark"
+BENCHMARK_PASSWORD = "benchmark"
+SEED_BATCH_SIZE = 1000
+# routes measured by run, each request picks one in turn
+ROUTES = ("/", "/item/<id>", "/sentoffers", "/recievedoffers", "/friends", "/login")
+PERCENTILES = (50, 95, 99)
+DEFAULT_TOLERANCE = 0.25
+# times a client logging in before a run retries a full password hashing queue
+LOGIN_RETRIES = 10
+WORDS = (
+    "lamp desk chair textbook calculus chemistry bike helmet jacket mini fridge "
+    "monitor keyboard mouse kettle mirror rug poster shelf backpack guitar"
+).split()
+
+
+def _batches(docs, size=SEED_BATCH_SIZE):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(collection, docs):
+    count = 0
+    for batch in _batches(docs):
+        collection.insert_many(batch, ordered=False)
+        count += len(batch)
+    return count
+
+
+def seed(
+    db, users=1000, items=10000, offers=10000, friends=20, password_hash=b"", rng=None
+):
+    """
+    Inserts synthetic users, items and offers. Every user has the same password_hash.
+    Returns {"users": count, "items": count, "offers": count}.
+    """
+    rng = rng or random.Random(0)
+    user_ids = [ObjectId() for _ in range(users)]
+    now = datetime.datetime.utcnow()
+
+    def user_docs():
+        for number, user_id in enumerate(user_ids):
+            yield {
+                "_id": user_id,
+                "username": "bench%d" % number,
+                "password": password_hash,
+                "items": [],
+                "bio": "",
+                "pic": "https://i.imgur.com/xCvzudW.png",
+                "friends": [
+                    friend
+                    for friend in rng.sample(user_ids, min(friends + 1, users))
+                    if friend != user_id
+                ][:friends],
+            }
+
+    # the items of each user, so offers only offer the sender's own items
+    owned = {}
+
+    def item_docs():
+        for _ in range(items):
+            number = rng.randrange(users)
+            item_id = ObjectId()
+            owned.setdefault(number, []).append(str(item_id))
+            name = " ".join(rng.sample(WORDS, 2))
+            yield {
+                "_id": item_id,
+                "name": name,
+                "description": "A used %s in good condition." % name,
+                "user": user_ids[number],
+                "username": "bench%d" % number,
+                "image_url": "https://i.imgur.com/xCvzudW.png",
+                "price": Decimal128(
+                    "%d.%02d" % (rng.randrange(500), rng.randrange(100))
+                ),
+                "created_at": now
+                - datetime.timedelta(seconds=rng.randrange(365 * 86400)),
+                "public": rng.random() < 0.9,
+            }
+
+    def offer_docs():
+        owners = list(owned)
+        for _ in range(offers if len(owners) > 1 else 0):
+            owner, sender = rng.sample(owners, 2)
+            offered = owned[sender]
+            yield {
+                "offerforid": rng.choice(owned[owner]),
+                "offereditems": rng.sample(
+                    offered, min(len(offered), rng.randint(1, 3))
+                ),
+                "sentby": user_ids[sender],
+                "status": rng.choice(("sent", "sent", "sent", "accepted", "rejected")),
+                "sendtouser": user_ids[owner],
+            }
+
+    return {
+        "users": _insert(db.users, user_docs()),
+        "items": _insert(db.items, item_docs()),
+        "offers": _insert(db.offers, offer_docs()),
+    }
+
+
+def synthetic_offers(users, items, offers, rng=None):
+    """
+    Yields offers between random users without a database, item n belonging to
+    user n % users
+    """
+    rng = rng or random.Random(0)
+    for number in range(offers):
+        wanted = rng.randrange(items)
+        owner = wanted % users
+        sender = rng.randrange(users - 1)
+        sender += sender >= owner  # anyone but the owner
+        own_items = range(sender, items, users)
+        offered = rng.sample(own_items, min(len(own_items), rng.randint(1, 3)))
+        yield {
+            "_id": number,
+            "status": "sent",
+            "offerforid": wanted,
+            "offereditems": offered,
+            "sentby": sender,
+            "sendtouser": owner,
+        }
+
+
+def match(offers=100000, users=10000, items=None, max_length=4, added=1000, rng=None):
+    """
+    Times matching.TradeGraph on synthetic offers.
+    Returns {"offers", "rings", "match_seconds", "add_ms"}.
+    """
+    from matching import TradeGraph
+
+    rng = rng or random.Random(0)
+    items = items or offers
+    generated = list(synthetic_offers(users, items, offers + added, rng))
+    graph = TradeGraph(max_length)
+    start = time.perf_counter()
+    rings = graph.load(generated[:offers])
+    match_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for offer in generated[offers:]:
+        graph.add_offer(offer)
+    add_seconds = time.perf_counter() - start
+    return {
+        "offers": offers,
+        "rings": rings,
+        "match_seconds": round(match_seconds, 3),
+        "add_ms": round(add_seconds / max(added, 1) * 1000, 3),
+    }
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize(samples, elapsed):
+    """
+    Turns {route: [(seconds, ok)]} into
+    {route: {"requests", "errors", "p50_ms", "p95_ms", "p99_ms", "throughput"}}
+    """
+    report = {}
+    for route, results in samples.items():
+        latencies = sorted(seconds for seconds, _ in results)
+        stats = {
+            "requests": len(results),
+            "errors": sum(1 for _, ok in results if not ok),
+            "throughput": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        }
+        for percent in PERCENTILES:
+            stats["p%d_ms" % percent] = round(percentile(latencies, percent) * 1000, 2)
+        report[route] = stats
+    return report
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns a message for every route whose p95 is more than tolerance above baseline
+    """
+    regressions = []
+    for route, stats in report.items():
+        before = baseline.get(route)
+        if not before or not before.get("p95_ms"):
+            continue
+        limit = before["p95_ms"] * (1 + tolerance)
+        if stats["p95_ms"] > limit:
+            regressions.append(
+                "%s p95 %.2f ms, baseline %.2f ms"
+                % (route, stats["p95_ms"], before["p95_ms"])
+            )
+    return regressions
+
+
+def _log_in(app, username, retries=0):
+    """
+    Logs a new test client in as username. A 503 from a full password hashing queue
+    is retried up to retries times, after the Retry-After it asks for.
+    Returns (client, logged in).
+    """
+    client = app.test_client()
+    form = {"fusername": username, "fpassword": BENCHMARK_PASSWORD}
+    for attempt in range(retries + 1):
+        response = client.post("/login", data=form)
+        if response.status_code != 503 or attempt == retries:
+            break
+        delay = float(response.headers.get("Retry-After", "1"))
+        # spread the retries of the other clients stuck in the same burst
+        time.sleep(delay * (1 + random.random()))
+    return client, response.status_code == 302
+
+
+def run(app, db, requests=1000, concurrency=8, warmup=50, rng=None):
+    """
+    Drives ROUTES from concurrency logged in clients.
+    Returns (summarize() report, elapsed seconds).
+    """
+    rng = rng or random.Random(0)
+    users = [
+        user["username"]
+        for user in db.users.aggregate(
+            [{"$sample": {"size": concurrency}}, {"$project": {"username": 1}}]
+        )
+    ]
+    # item pages are requested for a random sample of public items
+    item_ids = [
+        str(item["_id"])
+        for item in db.items.aggregate(
+            [
+                {"$match": {"public": True}},
+                {"$sample": {"size": 1000}},
+                {"$project": {"_id": 1}},
+            ]
+        )
+    ]
+    if not users or not item_ids:
+        raise SystemExit("Nothing to benchmark, run seed first")
+
+    def request(client, username, route):
+        if route == "/login":
+            return _log_in(app, username)[1]
+        path = route.replace("<id>", rng.choice(item_ids))
+        return client.get(path).status_code == 200
+
+    samples = {route: [] for route in ROUTES}
+    lock = threading.Lock()
+    counter = iter(range(warmup + requests))
+
+    def worker(username):
+        client, ok = _log_in(app, username, LOGIN_RETRIES)
+        if not ok:
+            raise SystemExit("Could not log in as %s" % username)
+        while True:
+            with lock:
+                number = next(counter, None)
+            if number is None:
+                return
+            route = ROUTES[number % len(ROUTES)]
+            start = time.perf_counter()
+            try:
+                ok = request(client, username, route)
+            except Exception:
+                ok = False
+            seconds = time.perf_counter() - start
+            if number >= warmup:
+                with lock:
+                    samples[route].append((seconds, ok))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        futures = [
+            pool.submit(worker, users[number % len(users)])
+            for number in range(concurrency)
+        ]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+    return summarize(samples, elapsed), elapsed
+
+
+def _print_report(report, elapsed):
+    columns = ("requests", "errors", "p50_ms", "p95_ms", "p99_ms", "throughput")
+    print(" * %-16s" % "route", *("%10s" % column for column in columns))
+    for route, stats in report.items():
+        print(" * %-16s" % route, *("%10s" % stats[column] for column in columns))
+    total = sum(stats["requests"] for stats in report.values())
+    rate = total / elapsed if elapsed else 0.0
+    print(" * %d requests in %.2f s, %.2f req/s" % (total, elapsed, rate))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed and benchmark CampusSwap.")
+    parser.add_argument("command", choices=("seed", "run", "match"))
+    parser.add_argument("--database", default=BENCHMARK_DATABASE)
+    parser.add_argument(
+        "--mock",
+        action="store_true",
+        help="seed and run against mongomock in this process",
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--offers", type=int)
+    parser.add_argument("--friends", type=int, default=20, help="friends per user")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--save", help="write the report to this baseline file")
+    parser.add_argument("--compare", help="fail on a p95 regression against this file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--length", type=int, default=4, help="longest trade ring")
+    args = parser.parse_args()
+
+    if args.command == "match":
+        offers = args.items if args.offers is None else args.offers
+        result = match(offers, args.users, max_length=args.length)
+        print(
+            " * %(offers)d offers, %(rings)d rings, matched in %(match_seconds)s s,"
+            " %(add_ms)s ms per new offer" % result
+        )
+        return
+
+    if args.mock:
+        # must happen before the app opens its first connection
+        import mongomock
+        import pymongo
+
+        pymongo.MongoClient = mongomock.MongoClient
+
+    from app import app, db, hasher
+    from indexes import ensure_indexes
+
+    if args.database == os.getenv("MONGO_DB_NAME", "Cluster0"):
+        raise SystemExit("Refusing to seed the application database %s" % args.database)
+    db.configure(name=args.database)
+
+    if args.command == "seed" or args.mock:
+        for collection in ("users", "items", "offers", "meta"):
+            db[collection].drop()
+        ensure_indexes(db)
+        start = time.perf_counter()
+        counts = seed(
+            db,
+            users=args.users,
+            items=args.items,
+            offers=args.items if args.offers is None else args.offers,
+            friends=args.friends,
+            password_hash=hasher.hash(BENCHMARK_PASSWORD),
+        )
+        print(" * Seeded", counts, "in %.1f s" % (time.perf_counter() - start))
+        if args.command == "seed":
+            return
+
+    app.config.update({"TESTING": True})
+    report, elapsed = run(app, db, args.requests, args.concurrency, args.warmup)
+    _print_report(report, elapsed)
+
+    if args.save:
+        scale = {
+            name: db[name].estimated_document_count()
+            for name in ("users", "items", "offers")
+        }
+        baseline = {"scale": scale, "concurrency": args.concurrency, "routes": report}
+        with open(args.save, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline["routes"], args.tolerance)
+        for message in regressions:
+            print(" * REGRESSION", message)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
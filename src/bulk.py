@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Bulk import and export of a user's listings as CSV or JSON Lines.
+
+Imports are read row by row and written with insert_many(ordered=False) in
+fixed-size batches, so a large upload never sits in memory all at once and one
+bad row does not stop the others. Every row that is rejected, either by
+validation or by the database, is reported with its row number. A file that
+stops being readable part way is imported up to that point and the error is
+reported with the rows that made it in. finish_import() then brings the
+feeds and profile counters up to date.
+
+Exports stream the same db.items.find({"user": ...}) query view_listings uses,
+one row at a time.
+
+From the command line:
+
+    python bulk.py import <username> listings.csv
+    python bulk.py export <username> --format jsonl > listings.jsonl
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import sys
+from decimal import Decimal, InvalidOperation
+
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+from profiles import recount
+from social import publish_items
+
+IMPORT_BATCH_SIZE = 500
+# stop collecting errors after this many so a broken file cannot use up memory
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ("csv", "jsonl")
+# columns of an export, and the columns an import understands
+EXPORT_FIELDS = ("name", "description", "price", "image_url", "public", "created_at")
+MAX_NAME_LENGTH = 200
+MAX_DESCRIPTION_LENGTH = 5000
+
+
+def read_rows(stream, fmt):
+    """
+    Yields (row number, dict) for every row of a binary stream in the given format.
+    Rows that cannot be parsed are yielded as (row number, ValueError).
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if fmt == "csv":
+        for number, row in enumerate(csv.DictReader(text), start=1):
+            yield number, row
+        return
+    for number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, ValueError("invalid JSON: %s" % e)
+            continue
+        if not isinstance(row, dict):
+            yield number, ValueError("each line must be a JSON object")
+            continue
+        yield number, row
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if value is None or value == "":
+        return True
+    text = str(value).strip().lower()
+    if text in ("true", "yes", "1"):
+        return True
+    if text in ("false", "no", "0"):
+        return False
+    raise ValueError("public must be true or false")
+
+
+def validate_row(row, user):
+    """
+    Turns an imported row into an item document for user, raising ValueError if the row is invalid
+    """
+    name = str(row.get("name") or "").strip()
+    if not name:
+        raise ValueError("name is required")
+    if len(name) > MAX_NAME_LENGTH:
+        raise ValueError("name is too long")
+    description = str(row.get("description") or "")
+    if len(description) > MAX_DESCRIPTION_LENGTH:
+        raise ValueError("description is too long")
+    try:
+        price = Decimal(str(row.get("price", "")).strip())
+    except InvalidOperation:
+        raise ValueError("price must be a number")
+    if not price.is_finite() or price < 0:
+        raise ValueError("price must be a positive number")
+    return {
+        "name": name,
+        "description": description,
+        "user": user["_id"],
+        "username": user["username"],
+        "image_url": str(row.get("image_url") or row.get("url") or ""),
+        "price": Decimal128(price),
+        "created_at": datetime.datetime.utcnow(),
+        "public": _parse_bool(row.get("public")),
+    }
+
+
+def _insert_batch(items, batch, result):
+    # batch is a list of (row number, document)
+    try:
+        items.insert_many([doc for _, doc in batch], ordered=False)
+        result["inserted"] += len(batch)
+    except BulkWriteError as e:
+        details = e.details
+        result["inserted"] += details.get("nInserted", 0)
+        for error in details.get("writeErrors", []):
+            _add_error(result, batch[error["index"]][0], error.get("errmsg", "write failed"))
+
+
+def _add_error(result, number, message):
+    result["failed"] += 1
+    if len(result["errors"]) < MAX_REPORTED_ERRORS:
+        result["errors"].append({"row": number, "error": str(message)})
+
+
+def import_items(items, rows, user, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Validates and inserts (row number, row) pairs as listings of user.
+    Returns {"inserted": count, "failed": count, "errors": [{"row": number, "error": message}]},
+    plus "error" if the file could not be read to the end.
+    """
+    result = {"inserted": 0, "failed": 0, "errors": []}
+    batch = []
+    try:
+        for number, row in rows:
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                batch.append((number, validate_row(row, user)))
+            except ValueError as e:
+                _add_error(result, number, e)
+                continue
+            if len(batch) >= batch_size:
+                _insert_batch(items, batch, result)
+                batch = []
+    except (csv.Error, UnicodeDecodeError) as e:
+        # the rows read so far are still imported
+        result["error"] = "could not read the file: %s" % e
+    if batch:
+        _insert_batch(items, batch, result)
+    return result
+
+
+def finish_import(db, feed_cache, user_id, started):
+    """
+    Updates the home feed, the counters of user_id and the friends feeds after
+    an import that started at started (a UTC datetime) inserted listings
+    """
+    feed_cache.invalidate()
+    recount(db, user_id)
+    # MongoDB keeps milliseconds, the second of slack catches every imported row
+    imported = db.items.find(
+        {
+            "user": ObjectId(user_id),
+            "public": True,
+            "created_at": {"$gte": started - datetime.timedelta(seconds=1)},
+        },
+        {"user": 1, "created_at": 1},
+    )
+    publish_items(db, imported)
+
+
+def _export_value(value):
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def export_items(items, user_id, fmt="csv"):
+    """
+    Yields the listings of user_id as CSV or JSON Lines text, one row at a time
+    """
+    cursor = items.find(
+        {"user": ObjectId(user_id)}, dict.fromkeys(EXPORT_FIELDS, 1)
+    ).batch_size(IMPORT_BATCH_SIZE)
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for doc in cursor:
+            writer.writerow({key: _export_value(doc.get(key)) for key in EXPORT_FIELDS})
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+    for doc in cursor:
+        row = {key: _export_value(doc.get(key)) for key in EXPORT_FIELDS}
+        yield json.dumps(row) + "\n"
+
+
+def main():
+    from app import db, feed_cache
+
+    parser = argparse.ArgumentParser(description="Import or export CampusSwap listings.")
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("username")
+    parser.add_argument("file", nargs="?", help="file to import, - for stdin")
+    parser.add_argument("--format", choices=FORMATS)
+    args = parser.parse_args()
+
+    user = db.users.find_one({"username": args.username})
+    if not user:
+        raise SystemExit("No user named %s" % args.username)
+
+    if args.command == "export":
+        for chunk in export_items(db.items, user["_id"], args.format or "csv"):
+            sys.stdout.write(chunk)
+        return
+
+    if not args.file:
+        raise SystemExit("import needs a file")
+    fmt = args.format or ("csv" if args.file.endswith(".csv") else "jsonl")
+    if args.file == "-":
+        stream = sys.stdin.buffer
+    else:
+        stream = open(args.file, "rb")
+    started = datetime.datetime.utcnow()
+    with stream:
+        result = import_items(db.items, read_rows(stream, fmt), user)
+    if result["inserted"]:
+        finish_import(db, feed_cache, user["_id"], started)
+    print(" * Imported", result["inserted"], "listings,", result["failed"], "failed")
+    for error in result["errors"]:
+        print("   row", error["row"], "-", error["error"])
+    if "error" in result:
+        raise SystemExit(result["error"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Deleting items together with the offers that refer to them.
+
+delete_item removes an item and every offer that wants it or offers it in one
+server side call. On a replica set both deletes run in one transaction; on a
+standalone server (like the docker-compose one) the offers are deleted first,
+so a failure in between leaves an item without offers rather than offers
+without an item. The pending offer counters of users can then drift from the
+offers too, until the next sweep repairs them.
+
+sweep_orphaned_offers finds offers that point at items which no longer exist,
+for data deleted before this was in place, and removes them in batches. The
+background sweeper then recounts pending offers with profiles.repair_pending.
+Run this file directly to sweep once:
+
+    python cleanup.py
+"""
+
+import logging
+
+from bson.objectid import ObjectId
+
+from database import run_transaction, start_periodic
+from notifications import TOMBSTONE_FIELDS, record_deletions
+from profiles import adjust, pending_by_recipient, repair_pending
+
+SWEEP_BATCH_SIZE = 500
+# the offer fields record_deletions needs
+TOMBSTONE_PROJECTION = dict.fromkeys(("status",) + TOMBSTONE_FIELDS, 1)
+
+log = logging.getLogger("campusswap.cleanup")
+
+
+def offers_for_item(item_id):
+    """
+    Filter for every offer that wants item_id or offers it, served by the offerforid and offereditems indexes
+    """
+    item_id = str(item_id)
+    return {"$or": [{"offerforid": item_id}, {"offereditems": item_id}]}
+
+
+def delete_item(db, item_id):
+    """
+    Deletes an item and the offers that refer to it, and updates the counters
+    of the owner and of the users who had pending offers for or with it.
+    Returns (items deleted, offers deleted).
+    """
+
+    def delete(session=None):
+        query = offers_for_item(item_id)
+        pending = pending_by_recipient(db, query, session=session)
+        pending_offers = db.offers.find(
+            {"$and": [query, {"status": "sent"}]}, TOMBSTONE_PROJECTION, session=session
+        )
+        record_deletions(db, pending_offers, session=session)
+        offers = db.offers.delete_many(query, session=session)
+        item = db.items.find_one_and_delete(
+            {"_id": ObjectId(item_id)}, {"user": 1, "public": 1}, session=session
+        )
+        if item and item.get("user"):
+            adjust(
+                db,
+                item["user"],
+                session=session,
+                listings=-1,
+                public=-int(item.get("public", False)),
+            )
+        for user_id, count in pending.items():
+            adjust(db, user_id, session=session, offers_pending=-count)
+        return int(item is not None), offers.deleted_count
+
+    return run_transaction(db, delete)
+
+
+def _missing_items(db, item_ids):
+    # the ids among item_ids that are not valid or have no item, live or archived
+    valid = {ObjectId(item_id) for item_id in item_ids if ObjectId.is_valid(item_id)}
+    found = set()
+    for collection in (db.items, db.items_archive):
+        query = {"_id": {"$in": list(valid)}}
+        found.update(str(item["_id"]) for item in collection.find(query, {"_id": 1}))
+    return {item_id for item_id in item_ids if item_id not in found}
+
+
+def sweep_orphaned_offers(db, batch_size=SWEEP_BATCH_SIZE):
+    """
+    Deletes offers whose wanted item or any offered item no longer exists.
+    Walks the offers in _id order, batch_size at a time, with one items query
+    and at most one delete per batch. Returns the number of offers deleted.
+    """
+    deleted = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        batch = list(
+            db.offers.find(query, TOMBSTONE_PROJECTION)
+            .sort("_id", 1)
+            .limit(batch_size)
+        )
+        if not batch:
+            return deleted
+        last_id = batch[-1]["_id"]
+
+        item_ids = set()
+        for offer in batch:
+            item_ids.add(str(offer.get("offerforid")))
+            item_ids.update(str(item_id) for item_id in offer.get("offereditems", []))
+        missing = _missing_items(db, item_ids)
+
+        orphans = [
+            offer["_id"]
+            for offer in batch
+            if str(offer.get("offerforid")) in missing
+            or any(str(item_id) in missing for item_id in offer.get("offereditems", []))
+        ]
+        if orphans:
+            record_deletions(db, [offer for offer in batch if offer["_id"] in orphans])
+            deleted += db.offers.delete_many({"_id": {"$in": orphans}}).deleted_count
+            pending = {}
+            for offer in batch:
+                if offer["_id"] in orphans and offer.get("status") == "sent":
+                    recipient = offer.get("sendtouser")
+                    pending[recipient] = pending.get(recipient, 0) + 1
+            for user_id, count in pending.items():
+                if user_id is not None:
+                    adjust(db, user_id, offers_pending=-count)
+
+
+def sweep(db, batch_size=SWEEP_BATCH_SIZE):
+    """
+    Deletes orphaned offers, then repairs the pending offer counters.
+    Returns (offers deleted, users fixed).
+    """
+    return sweep_orphaned_offers(db, batch_size), repair_pending(db)
+
+
+def start_sweeper(db, interval, batch_size=SWEEP_BATCH_SIZE):
+    """
+    Starts a daemon thread that sweeps every interval seconds
+    """
+
+    return start_periodic(
+        interval, lambda: sweep(db, batch_size), log, "orphaned offer sweep"
+    )
+
+
+if __name__ == "__main__":
+    from app import db
+
+    deleted, fixed = sweep(db)
+    print(" * Deleted", deleted, "orphaned offers and fixed", fixed, "counters")
@@ -0,0 +1,340 @@
+"""
+Fork-safe, lazily connected handle on the app's MongoDB database.
+
+A MongoClient must not be carried across a fork, and the WSGI server forks
+its workers after importing app.py. Database therefore only builds the client
+on first use, and builds a new one when it notices it is running in a
+different process than the one that built the current client.
+
+Every connection setting comes from the environment, see client_options_from_env()
+and OPERATION_CLASSES.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import pymongo
+from pymongo import monitoring
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import read_pref_mode_from_name, make_read_preference
+from pymongo.write_concern import WriteConcern
+
+log = logging.getLogger("campusswap.database")
+
+# read preference and write concern for each kind of operation. The defaults
+# below can be changed with MONGO_READ_PREFERENCE_<CLASS> and
+# MONGO_WRITE_CONCERN_<CLASS>, e.g. MONGO_READ_PREFERENCE_FEED=secondaryPreferred
+OPERATION_CLASSES = {
+    # anything not listed below
+    "default": {"read_preference": "primary", "write_concern": "1"},
+    # public listing pages, which can tolerate slightly stale data
+    "feed": {"read_preference": "primaryPreferred", "write_concern": "1"},
+    # users, logins and profiles
+    "account": {"read_preference": "primary", "write_concern": "majority"},
+    # offers and trades
+    "trade": {"read_preference": "primary", "write_concern": "majority"},
+}
+
+# error code of "Transaction numbers are only allowed on a replica set member or mongos"
+ILLEGAL_OPERATION = 20
+
+# environment variable -> MongoClient keyword, all integers
+_INT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+}
+
+
+def uri_from_env():
+    """
+    Returns MONGO_URI if it is set (e.g. for Atlas), otherwise the connection
+    string for the containerized instance of mongo
+    """
+    if os.getenv("MONGO_URI"):
+        return os.environ["MONGO_URI"]
+    root_username = os.environ["MONGO_INITDB_ROOT_USERNAME"]
+    root_password = os.environ["MONGO_INITDB_ROOT_PASSWORD"]
+    host = os.getenv("MONGO_HOST", "mongodb:27017")
+    return f"mongodb://{root_username}:{root_password}@{host}/db?authSource=admin"
+
+
+def client_options_from_env():
+    """
+    Returns the MongoClient keyword arguments set in the environment
+    """
+    options = {}
+    for variable, option in _INT_OPTIONS.items():
+        if os.getenv(variable):
+            options[option] = int(os.environ[variable])
+    return options
+
+
+def _write_concern(value):
+    return WriteConcern(w=int(value) if value.isdigit() else value)
+
+
+def _read_preference(name):
+    return make_read_preference(read_pref_mode_from_name(name), None)
+
+
+def _supports_transactions(client):
+    # Unknown until the client has talked to the server, in which case we try
+    return client.topology_description.topology_type_name != "Single"
+
+
+def run_transaction(database, callback):
+    """
+    Returns callback(session) run in a transaction on a replica set or sharded
+    cluster, or callback(None) on a standalone server, which has no transactions
+    """
+    client = database.client
+    if _supports_transactions(client):
+        try:
+            with client.start_session() as session:
+                return session.with_transaction(callback)
+        except OperationFailure as e:
+            if e.code != ILLEGAL_OPERATION:
+                raise
+    return callback(None)
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Counts connection pool events for each server, for the readiness endpoint
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def _server(self, address):
+        key = "%s:%s" % address
+        if key not in self._servers:
+            self._servers[key] = {
+                "open": 0,
+                "checked_out": 0,
+                "checkouts": 0,
+                "checkout_failures": 0,
+                "checkout_seconds": 0.0,
+                "cleared": 0,
+            }
+        return self._servers[key]
+
+    def _update(self, address, **changes):
+        with self._lock:
+            server = self._server(address)
+            for key, change in changes.items():
+                server[key] += change
+
+    def pool_created(self, event):
+        self._update(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._update(event.address, cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._update(event.address, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._update(event.address, open=-1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._update(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._update(
+            event.address,
+            checked_out=1,
+            checkouts=1,
+            checkout_seconds=getattr(event, "duration", 0.0) or 0.0,
+        )
+
+    def connection_checked_in(self, event):
+        self._update(event.address, checked_out=-1)
+
+    def snapshot(self):
+        """
+        Returns a copy of the counters, keyed by server address
+        """
+        with self._lock:
+            return {key: dict(server) for key, server in self._servers.items()}
+
+
+class Database:
+    """
+    Stands in for a pymongo Database: db.items, db["items"] and so on are
+    forwarded to the database of this process' MongoClient.
+    """
+
+    def __init__(self, name="Cluster0", uri=None, **client_options):
+        self.name = name
+        self.uri = uri
+        self.client_options = client_options
+        self.operation_classes = {
+            key: dict(value) for key, value in OPERATION_CLASSES.items()
+        }
+        self.pool_stats = PoolStats()
+        self.listeners = [self.pool_stats]
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._on_connect = []
+        self._operations = {}
+
+    @classmethod
+    def from_env(cls):
+        """
+        Builds a Database configured by MONGO_URI (or the MONGO_INITDB_* credentials),
+        MONGO_DB_NAME, the pool and timeout settings in client_options_from_env()
+        and the per class MONGO_READ_PREFERENCE_* and MONGO_WRITE_CONCERN_* settings
+        """
+        database = cls(os.getenv("MONGO_DB_NAME", "Cluster0"), **client_options_from_env())
+        for name, settings in database.operation_classes.items():
+            suffix = name.upper()
+            settings["read_preference"] = os.getenv(
+                "MONGO_READ_PREFERENCE_" + suffix, settings["read_preference"]
+            )
+            settings["write_concern"] = os.getenv(
+                "MONGO_WRITE_CONCERN_" + suffix, settings["write_concern"]
+            )
+        return database
+
+    def configure(self, name=None, uri=None, **client_options):
+        """
+        Changes the connection settings. Takes effect on the next connection.
+        """
+        if name is not None:
+            self.name = name
+        if uri is not None:
+            self.uri = uri
+        self.client_options.update(client_options)
+        self.close()
+
+    def operation(self, name):
+        """
+        Returns the pymongo Database to use for an operation class in OPERATION_CLASSES,
+        with that class' read preference and write concern
+        """
+        if self._pid != os.getpid() or name not in self._operations:
+            settings = self.operation_classes.get(name, self.operation_classes["default"])
+            self._operations[name] = self.client.get_database(
+                self.name,
+                read_preference=_read_preference(settings["read_preference"]),
+                write_concern=_write_concern(settings["write_concern"]),
+            )
+        return self._operations[name]
+
+    def add_listener(self, listener):
+        """
+        Registers a pymongo event listener. Only clients created afterwards use it.
+        """
+        self.listeners.append(listener)
+
+    def on_connect(self, callback):
+        """
+        Registers callback(database) to run whenever a process opens its connection
+        """
+        self._on_connect.append(callback)
+        return callback
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._connect()
+        return self._client
+
+    def _connect(self):
+        # a client inherited from the parent process is dropped without being
+        # closed, closing it would tear down the parent's sockets.
+        # connect=False defers the first connection until the first operation
+        options = dict(self.client_options)
+        options.setdefault("connect", False)
+        options["event_listeners"] = list(options.get("event_listeners", [])) + self.listeners
+        self._client = pymongo.MongoClient(self.uri or uri_from_env(), **options)
+        self._pid = os.getpid()
+        self._operations = {}
+        if self._on_connect:
+            # run the callbacks in the background so the first request does not wait on them
+            threading.Thread(
+                target=self._run_on_connect, args=(self._client[self.name],), daemon=True
+            ).start()
+
+    def _run_on_connect(self, database):
+        try:
+            for callback in self._on_connect:
+                callback(database)
+        except Exception as e:
+            log.error("MongoDB connection error: %s", e)
+
+    def ping(self, timeout=None):
+        """
+        Pings the server, giving up after timeout seconds.
+        Returns the round trip time in seconds, raises if the server is unreachable.
+        """
+        start = time.perf_counter()
+        with pymongo.timeout(timeout):
+            # The ping command is cheap and does not require auth.
+            self.client.admin.command("ping")
+        return time.perf_counter() - start
+
+    def get(self):
+        """
+        Returns the pymongo Database for this process
+        """
+        return self.client[self.name]
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __getitem__(self, name):
+        return self.get()[name]
+
+
+def start_periodic(interval, task, logger, description):
+    """
+    Starts a daemon thread that runs task() every interval seconds for the life of
+    the process. Failures are logged to logger as "<description> failed" and the
+    next run goes ahead.
+    """
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                task()
+            except Exception:
+                logger.exception("%s failed", description)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
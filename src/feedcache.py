@@ -0,0 +1,82 @@
+"""
+Cache of the rendered public marketplace feed.
+
+Anonymous visitors all see the same feed, so the rendered page for each sort
+mode and cursor is kept in memory and reused. The feed has a version number
+stored in the "meta" collection; every write to a listing bumps it, which both
+makes the cached pages of the old version unreachable in every worker and
+changes the ETag, so browsers revalidating with If-None-Match get a 304 only
+while nothing has changed. The number of public listings shown above the feed
+is counted once per version as well.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+FEED_META_ID = "feed"
+
+
+class FeedCache:
+    """
+    LRU bounded cache of rendered feed pages keyed by feed version and request
+    """
+
+    def __init__(self, db, maxsize=256):
+        self.db = db
+        self.maxsize = maxsize
+        self._pages = OrderedDict()  # (version, key) -> rendered page
+        self._count = (None, None)  # (version, number of public listings)
+        self._lock = threading.Lock()
+
+    def version(self):
+        """
+        Returns (version, last modified datetime or None) of the feed
+        """
+        meta = self.db.meta.find_one({"_id": FEED_META_ID})
+        if not meta:
+            return 0, None
+        return meta.get("version", 0), meta.get("modified")
+
+    def etag(self, version, key):
+        raw = repr((version, key)).encode("utf-8")
+        return hashlib.sha1(raw).hexdigest()
+
+    def get(self, version, key):
+        with self._lock:
+            page = self._pages.get((version, key))
+            if page is not None:
+                self._pages.move_to_end((version, key))
+            return page
+
+    def put(self, version, key, page):
+        with self._lock:
+            self._pages[(version, key)] = page
+            self._pages.move_to_end((version, key))
+            while len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+
+    def count(self, version, counter):
+        """
+        Returns counter() for a feed version, counting only the first time the
+        version is asked for in this process
+        """
+        with self._lock:
+            counted_version, count = self._count
+        if counted_version != version:
+            count = counter()
+            with self._lock:
+                self._count = (version, count)
+        return count
+
+    def invalidate(self):
+        """
+        Bumps the feed version. Call this after every write that changes a listing.
+        """
+        self.db.meta.update_one(
+            {"_id": FEED_META_ID},
+            {"$inc": {"version": 1}, "$currentDate": {"modified": True}},
+            upsert=True,
+        )
+        with self._lock:
+            self._pages.clear()
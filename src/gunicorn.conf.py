@@ -0,0 +1,12 @@
+# gunicorn settings for serving the app in production, read from the environment
+# run with: gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = "0.0.0.0:" + os.getenv("FLASK_PORT", "5001")
+# worker processes, each with its own MongoClient and user cache
+workers = int(os.getenv("WEB_WORKERS", "2"))
+# threads per worker, each thread can hold one MongoDB connection at a time
+threads = int(os.getenv("WEB_THREADS", "4"))
+worker_class = "gthread"
+timeout = int(os.getenv("WEB_TIMEOUT", "30"))
+accesslog = "-"
@@ -0,0 +1,160 @@
+"""
+Runs bcrypt password hashing off the request thread.
+
+bcrypt is deliberately slow, so hashing on the request thread lets a burst of
+logins hold up every other route. PasswordHasher sends the work to a small
+thread or process pool instead and only lets a bounded number of calls wait
+for it. When the pool is full it raises HasherBusy straight away, and the
+route answers with a 503 and a Retry-After header instead of queueing more work.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import bcrypt
+
+
+class HasherBusy(Exception):
+    """
+    Raised when the hashing pool is full or a call took longer than the timeout
+    """
+
+
+def _hash(password, rounds):
+    if not password:
+        raise ValueError("Password must be non-empty.")
+    salt = bcrypt.gensalt(rounds=rounds)
+    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
+
+
+def _verify(hashed, password):
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+class HashStats:
+    """
+    Call count and timings for one kind of hashing call, in seconds
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.rejected = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.wait_total = 0.0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "rejected": self.rejected,
+            "total_seconds": self.total,
+            "max_seconds": self.max,
+            "mean_seconds": self.total / self.count if self.count else 0.0,
+            "mean_wait_seconds": self.wait_total / self.count if self.count else 0.0,
+        }
+
+
+def _timed(func, *args):
+    # runs in the pool, returns how long the call itself took
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords on a bounded thread or process pool
+    """
+
+    def __init__(
+        self, rounds=12, workers=2, queue_size=8, timeout=10.0, use_processes=False
+    ):
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self.use_processes = use_processes
+        self.stats = {"hash": HashStats(), "verify": HashStats()}
+        # calls running or waiting for a worker
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # the pool is created on first use, and again in a forked worker
+        # process because pools do not survive a fork
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                executor_class = (
+                    ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+                )
+                self._executor = executor_class(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, name, func, *args):
+        stats = self.stats[name]
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                stats.rejected += 1
+            raise HasherBusy("too many %s calls waiting" % name)
+        start = time.perf_counter()
+        try:
+            future = self._get_executor().submit(_timed, func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # the slot is held until the call is done, not until the caller stops
+        # waiting, so calls that timed out but still run count against the queue
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            result, duration = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # drops the call if no worker has started it yet
+            future.cancel()
+            with self._lock:
+                stats.rejected += 1
+            raise HasherBusy("%s call timed out" % name)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats.count += 1
+            stats.total += duration
+            stats.max = max(stats.max, duration)
+            stats.wait_total += elapsed - duration
+        return result
+
+    def hash(self, password):
+        """
+        Returns the bcrypt hash of password as a str
+        """
+        return self._run("hash", _hash, password, self.rounds)
+
+    def verify(self, hashed, password):
+        """
+        Checks password against a hash made by hash()
+        """
+        return self._run("verify", _verify, hashed, password)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+def hasher_from_env():
+    """
+    Builds a PasswordHasher configured by BCRYPT_LOG_ROUNDS, HASH_WORKERS,
+    HASH_QUEUE_SIZE, HASH_TIMEOUT and HASH_EXECUTOR ("thread" or "process")
+    """
+    workers = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+    return PasswordHasher(
+        rounds=int(os.getenv("BCRYPT_LOG_ROUNDS", "12")),
+        workers=workers,
+        queue_size=int(os.getenv("HASH_QUEUE_SIZE", str(workers * 4))),
+        timeout=float(os.getenv("HASH_TIMEOUT", "10")),
+        use_processes=os.getenv("HASH_EXECUTOR", "thread") == "process",
+    )
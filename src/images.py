@@ -0,0 +1,295 @@
+"""
+Listing and profile pictures, resized on the server and stored in GridFS.
+
+Saving a listing or a profile only registers its picture: an upload is stored
+as is and a URL is only written down, both in a pending document in the
+"images" collection, so the request never waits for a download or a resize.
+A worker thread in every web process claims pending images one at a time,
+fetches remote pictures, and stores a thumbnail and a detail rendition in the
+"renditions" GridFS bucket named after the SHA-256 of their bytes. A
+rendition's URL changes whenever its content does, so /images/<filename> can
+be cached by browsers for a year.
+
+When an image is ready its rendition file names are copied into the image
+field of every item and user whose image_id points at it, so pages never look
+images up while rendering. Until then they fall back to image_url or pic.
+
+Remote pictures are only fetched from public addresses: every connection,
+redirects included, resolves the host first and refuses loopback, private,
+link-local and reserved addresses, so a listing cannot make the server read
+its own network.
+
+GridFS needs a real pymongo Database, so pass db.operation(...) rather than
+the app's Database proxy.
+"""
+
+import datetime
+import hashlib
+import http.client
+import io
+import ipaddress
+import logging
+import re
+import socket
+import threading
+import urllib.parse
+import urllib.request
+
+import gridfs
+from PIL import Image, ImageOps
+from pymongo import ReturnDocument
+
+BUCKET = "renditions"
+# longest side of each rendition in pixels
+RENDITIONS = {"thumb": 400, "detail": 1200}
+JPEG_QUALITY = 85
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+# a 10 MB JPEG holds about this many pixels, anything larger is a decompression bomb
+MAX_SOURCE_PIXELS = 50 * 1000 * 1000
+FETCH_TIMEOUT = 10
+# an image still processing after this long was abandoned by a dead worker
+STALE_AFTER = datetime.timedelta(minutes=10)
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# what rendition file names look like, anything else in the bucket is not served
+RENDITION_NAME = re.compile(r"^[0-9a-f]{32}\.jpg$")
+
+log = logging.getLogger("campusswap.images")
+
+Image.MAX_IMAGE_PIXELS = MAX_SOURCE_PIXELS
+
+# set whenever this process adds an image, so its worker does not wait for the next poll
+_wake = threading.Event()
+
+
+def _read_limited(stream):
+    data = stream.read(MAX_SOURCE_BYTES + 1)
+    if not data:
+        raise ValueError("the image is empty")
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ValueError("the image is larger than %d MB" % (MAX_SOURCE_BYTES >> 20))
+    return data
+
+
+def _add(db, image):
+    image.update(status="pending", created_at=datetime.datetime.utcnow())
+    image_id = db.images.insert_one(image).inserted_id
+    _wake.set()
+    return image_id
+
+
+def add_upload(db, stream):
+    """
+    Stores an uploaded picture for processing and returns its image id.
+    Raises ValueError if the upload is empty or too large.
+    """
+    data = _read_limited(stream)
+    bucket = gridfs.GridFSBucket(db, BUCKET)
+    original = bucket.upload_from_stream("original", data)
+    return _add(db, {"source": "upload", "original": original})
+
+
+def _check_address(address):
+    address = ipaddress.ip_address(address.split("%")[0])
+    if getattr(address, "ipv4_mapped", None):
+        address = address.ipv4_mapped
+    if not address.is_global or address.is_multicast or address.is_reserved:
+        raise ValueError("the image URL must point to a public address")
+
+
+def _resolve(host, port):
+    # every address of host, checked, so a DNS answer cannot point us inside
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        raise ValueError("the image host %s cannot be found" % host)
+    addresses = [info[4][0] for info in infos]
+    for address in addresses:
+        _check_address(address)
+    return addresses[0]
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    # connects to the address that was checked, not to a second lookup of host
+    def connect(self):
+        address = _resolve(self.host, self.port)
+        self.sock = socket.create_connection(
+            (address, self.port), self.timeout, self.source_address
+        )
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection, _PublicHTTPConnection):
+    # HTTPSConnection.connect wraps the socket _PublicHTTPConnection.connect opened
+    pass
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req, context=self._context)
+
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urllib.parse.urlsplit(newurl).scheme not in ("http", "https"):
+            raise ValueError("the image URL redirects to %s" % newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# no proxies, so the address checked is the one connected to
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}),
+    _PublicHTTPHandler,
+    _PublicHTTPSHandler,
+    _RedirectHandler,
+)
+
+
+def add_url(db, url):
+    """
+    Registers a remote picture to be fetched and returns its image id.
+    Raises ValueError if url is not an http or https URL or names a non-public
+    IP address.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        raise ValueError("the image URL must start with http:// or https://")
+    if not parts.hostname:
+        raise ValueError("the image URL has no host")
+    try:
+        ipaddress.ip_address(parts.hostname)
+    except ValueError:
+        pass  # a host name, only resolved when the picture is fetched
+    else:
+        _check_address(parts.hostname)
+    return _add(db, {"source": "url", "url": url})
+
+
+def _fetch(url):
+    with _opener.open(url, timeout=FETCH_TIMEOUT) as response:
+        return _read_limited(response)
+
+
+def render(data, size):
+    """
+    Returns data resized to fit in a size x size square, as JPEG bytes
+    """
+    with Image.open(io.BytesIO(data)) as picture:
+        if picture.width * picture.height > MAX_SOURCE_PIXELS:
+            raise ValueError("the image is larger than %d pixels" % MAX_SOURCE_PIXELS)
+        picture = ImageOps.exif_transpose(picture).convert("RGB")
+        picture.thumbnail((size, size), Image.LANCZOS)
+        output = io.BytesIO()
+        picture.save(
+            output, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True
+        )
+    return output.getvalue()
+
+
+def _store(db, bucket, data):
+    # content addressed, so identical renditions are stored once
+    filename = hashlib.sha256(data).hexdigest()[:32] + ".jpg"
+    if not db[BUCKET + ".files"].find_one({"filename": filename}, {"_id": 1}):
+        bucket.upload_from_stream(filename, data)
+    return filename
+
+
+def _claim(db):
+    now = datetime.datetime.utcnow()
+    return db.images.find_one_and_update(
+        {
+            "$or": [
+                {"status": "pending"},
+                {"status": "processing", "claimed_at": {"$lt": now - STALE_AFTER}},
+            ]
+        },
+        {"$set": {"status": "processing", "claimed_at": now}},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def process_next(db):
+    """
+    Claims and processes one pending image.
+    Returns the processed image document, or None if there was nothing to do.
+    """
+    image = _claim(db)
+    if image is None:
+        return None
+    bucket = gridfs.GridFSBucket(db, BUCKET)
+    try:
+        if image["source"] == "upload":
+            data = bucket.open_download_stream(image["original"]).read()
+        else:
+            data = _fetch(image["url"])
+        renditions = {
+            name: _store(db, bucket, render(data, size))
+            for name, size in RENDITIONS.items()
+        }
+    except Exception as e:
+        db.images.update_one(
+            {"_id": image["_id"]}, {"$set": {"status": "failed", "error": str(e)}}
+        )
+        image.update(status="failed", error=str(e))
+        return image
+    finally:
+        if image["source"] == "upload":
+            try:
+                bucket.delete(image["original"])
+            except gridfs.errors.NoFile:
+                pass
+
+    db.images.update_one(
+        {"_id": image["_id"]},
+        {
+            "$set": {"status": "ready", "renditions": renditions},
+            "$unset": {"original": ""},
+        },
+    )
+    for collection in (db.items, db.users):
+        collection.update_many(
+            {"image_id": image["_id"]}, {"$set": {"image": renditions}}
+        )
+    image.update(status="ready", renditions=renditions)
+    return image
+
+
+def start_worker(db, interval, on_ready=None):
+    """
+    Starts a daemon thread that processes pending images, checking at least every
+    interval seconds. on_ready(image) is called after every image that becomes ready.
+    """
+
+    def loop():
+        while True:
+            _wake.wait(interval)
+            _wake.clear()
+            try:
+                while True:
+                    image = process_next(db)
+                    if image is None:
+                        break
+                    if image["status"] == "ready" and on_ready:
+                        on_ready(image)
+            except Exception:
+                log.exception("image processing failed")
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+
+def open_rendition(db, filename):
+    """
+    Returns a readable GridOut for a rendition file name, or None if there is none
+    """
+    if not RENDITION_NAME.match(filename):
+        return None
+    try:
+        return gridfs.GridFSBucket(db, BUCKET).open_download_stream_by_name(filename)
+    except gridfs.errors.NoFile:
+        return None
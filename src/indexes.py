@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Declares the indexes the routes in app.py rely on and checks that they are used.
+
+Run this file directly to create the indexes, and pass --explain to print the
+query plan of every route query:
+
+    python indexes.py --explain
+"""
+
+import argparse
+import logging
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+from pagination import DEFAULT_PAGE_SIZE
+
+log = logging.getLogger("campusswap.indexes")
+
+# every index we want, grouped by collection
+INDEXES = {
+    "users": [
+        # user_loader, request_loader, signup, login, view_user, add_friend
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        # copying finished profile pictures onto users
+        IndexModel([("image_id", ASCENDING)], name="image_id", sparse=True),
+        # the users who have someone as a friend, for the friends feed fan-out
+        IndexModel([("friends", ASCENDING)], name="friends"),
+    ],
+    "items": [
+        # view_listings, offer, export, and profile pages sorted by newest
+        IndexModel(
+            [
+                ("user", ASCENDING),
+                ("public", ASCENDING),
+                ("created_at", DESCENDING),
+                ("_id", DESCENDING),
+            ],
+            name="user_public_created_at",
+        ),
+        # home feed sorted by newest / oldest
+        IndexModel(
+            [("public", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="public_created_at",
+        ),
+        # home feed sorted by lowest / highest price
+        IndexModel(
+            [("public", ASCENDING), ("price", ASCENDING), ("_id", ASCENDING)],
+            name="public_price",
+        ),
+        # search, a collection can only have one text index
+        IndexModel(
+            [("name", TEXT), ("description", TEXT)],
+            name="name_description_text",
+            weights={"name": 10, "description": 2},
+        ),
+        # copying finished pictures onto items
+        IndexModel([("image_id", ASCENDING)], name="image_id", sparse=True),
+        # archive_items, private listings not updated for a while
+        IndexModel(
+            [("public", ASCENDING), ("updated_at", ASCENDING)],
+            name="public_updated_at",
+        ),
+    ],
+    "offers": [
+        # sentoffers and recievedoffers, newest first
+        IndexModel([("sentby", ASCENDING), ("_id", DESCENDING)], name="sentby_id"),
+        IndexModel(
+            [("sendtouser", ASCENDING), ("_id", DESCENDING)], name="sendtouser_id"
+        ),
+        # the same filtered by status, and the pending offer counters
+        IndexModel(
+            [("sentby", ASCENDING), ("status", ASCENDING), ("_id", DESCENDING)],
+            name="sentby_status_id",
+        ),
+        IndexModel(
+            [("sendtouser", ASCENDING), ("status", ASCENDING), ("_id", DESCENDING)],
+            name="sendtouser_status_id",
+        ),
+        # purge
+        IndexModel([("offerforid", ASCENDING)], name="offerforid"),
+        IndexModel([("offereditems", ASCENDING)], name="offereditems"),
+        # archive_offers, offers resolved a while ago
+        IndexModel(
+            [("status", ASCENDING), ("updated_at", ASCENDING)],
+            name="status_updated_at",
+        ),
+        # expire_offers, the oldest pending offers
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status_id"),
+        # offer notifications polling for changes when there are no change streams
+        IndexModel([("updated_at", ASCENDING)], name="updated_at"),
+    ],
+    "friend_feed": [
+        # friends_feed, newest first
+        IndexModel(
+            [("owner", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="owner_created_at",
+        ),
+        # fan-out upserts
+        IndexModel(
+            [("owner", ASCENDING), ("item", ASCENDING)],
+            name="owner_item_unique",
+            unique=True,
+        ),
+        # unpublishing a listing
+        IndexModel([("item", ASCENDING)], name="item"),
+    ],
+    "friend_suggestions": [
+        # suggestion upserts
+        IndexModel(
+            [("user", ASCENDING), ("candidate", ASCENDING)],
+            name="user_candidate_unique",
+            unique=True,
+        ),
+        # friends page, most mutual friends first
+        IndexModel(
+            [("user", ASCENDING), ("mutual", DESCENDING), ("candidate", ASCENDING)],
+            name="user_mutual",
+        ),
+    ],
+    "offers_archive": [
+        # offer_history, newest first
+        IndexModel([("sentby", ASCENDING), ("_id", DESCENDING)], name="sentby_id"),
+        IndexModel(
+            [("sendtouser", ASCENDING), ("_id", DESCENDING)], name="sendtouser_id"
+        ),
+    ],
+    "items_archive": [
+        # listing_history, newest first
+        IndexModel(
+            [("user", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="user_created_at",
+        ),
+    ],
+    "offer_deletions": [
+        # tombstones of deleted offers, read by the notifier polling for changes
+        IndexModel(
+            [("deleted_at", ASCENDING)], name="deleted_at_ttl", expireAfterSeconds=3600
+        ),
+    ],
+    "images": [
+        # the image worker claiming the oldest pending image
+        IndexModel(
+            [("status", ASCENDING), ("created_at", ASCENDING)],
+            name="status_created_at",
+        ),
+    ],
+}
+
+
+def ensure_indexes(db):
+    """
+    Creates every index in INDEXES. Indexes that already exist are left alone,
+    so this is safe to run on every start.
+    Returns a dict mapping collection name to the index names that were created or found.
+    """
+    created = {}
+    for collection, models in INDEXES.items():
+        try:
+            created[collection] = db[collection].create_indexes(models)
+        except OperationFailure as e:
+            # e.g. duplicate usernames already in the collection
+            log.error("could not create indexes on %s: %s", collection, e)
+    return created
+
+
+def route_queries(db):
+    """
+    Returns (description, cursor) pairs for the queries the routes run.
+    The ids are placeholders, the query planner does not need matching documents.
+    """
+    some_id = ObjectId()
+    feed = {"public": True}
+
+    def offer_page(query):
+        # what offers.hydrate_offers matches, sorts and limits before hydrating
+        return db.offers.find(query).sort("_id", -1).limit(DEFAULT_PAGE_SIZE + 1)
+
+    return [
+        ("user_loader", db.users.find({"username": "someone"})),
+        ("view_listings", db.items.find({"user": some_id})),
+        (
+            "profile",
+            db.items.find({"user": some_id, "public": True}).sort(
+                [("created_at", -1), ("_id", -1)]
+            ),
+        ),
+        ("home newest", db.items.find(feed).sort([("created_at", -1), ("_id", -1)])),
+        ("home oldest", db.items.find(feed).sort([("created_at", 1), ("_id", 1)])),
+        ("home lowest", db.items.find(feed).sort([("price", 1), ("_id", 1)])),
+        ("home highest", db.items.find(feed).sort([("price", -1), ("_id", -1)])),
+        ("search", db.items.find({"$text": {"$search": "lamp"}, "public": True})),
+        ("sentoffers", offer_page({"sentby": some_id})),
+        ("recievedoffers", offer_page({"sendtouser": some_id})),
+        ("sentoffers status", offer_page({"sentby": some_id, "status": "sent"})),
+        (
+            "recievedoffers status",
+            offer_page({"sendtouser": some_id, "status": "sent"}),
+        ),
+        (
+            "expire_offers",
+            db.offers.find({"status": "sent", "_id": {"$lt": some_id}}, {"_id": 1}),
+        ),
+        ("purge offereditems", db.offers.find({"offereditems": str(some_id)})),
+        ("purge offerforid", db.offers.find({"offerforid": str(some_id)})),
+        (
+            "friends_feed",
+            db.friend_feed.find({"owner": some_id}).sort(
+                [("created_at", -1), ("_id", -1)]
+            ),
+        ),
+        (
+            "friend suggestions",
+            db.friend_suggestions.find({"user": some_id}).sort(
+                [("mutual", -1), ("candidate", 1)]
+            ),
+        ),
+        ("friend fan-out", db.users.find({"friends": some_id})),
+        (
+            "archive_offers",
+            db.offers.find(
+                {
+                    "status": {"$in": ["accepted", "rejected"]},
+                    "updated_at": {"$lt": some_id.generation_time},
+                }
+            ),
+        ),
+        (
+            "archive_items",
+            db.items.find(
+                {
+                    "public": {"$ne": True},
+                    "updated_at": {"$lt": some_id.generation_time},
+                }
+            ),
+        ),
+        (
+            "offer_history",
+            db.offers_archive.find(
+                {"$or": [{"sentby": some_id}, {"sendtouser": some_id}]}
+            ).sort("_id", -1),
+        ),
+        (
+            "listing_history",
+            db.items_archive.find({"user": some_id}).sort(
+                [("created_at", -1), ("_id", -1)]
+            ),
+        ),
+    ]
+
+
+def _plan_stages(plan):
+    # walks a winning plan and yields (stage, index name) for every stage in it
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"], plan.get("indexName")
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+def explain_queries(db):
+    """
+    Runs explain() on every route query.
+    Returns a list of (description, index names, collection scan) tuples.
+    """
+    report = []
+    for description, cursor in route_queries(db):
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = list(_plan_stages(plan))
+        index_names = sorted({name for _, name in stages if name})
+        collscan = any(stage == "COLLSCAN" for stage, _ in stages)
+        report.append((description, index_names, collscan))
+    return report
+
+
+def main():
+    from app import db
+
+    parser = argparse.ArgumentParser(description="Create the CampusSwap indexes.")
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="print the query plan of every route query",
+    )
+    args = parser.parse_args()
+
+    for collection, names in ensure_indexes(db).items():
+        print(" *", collection + ":", ", ".join(names))
+
+    if args.explain:
+        scans = 0
+        for description, index_names, collscan in explain_queries(db):
+            if collscan:
+                scans += 1
+                print(" * COLLSCAN", description)
+            else:
+                print(" * IXSCAN  ", description, "(" + ", ".join(index_names) + ")")
+        if scans:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Finds rings of three or more users who could all trade at once.
+
+Every pending offer says its sender would give any of the offered items for
+the wanted item. TradeGraph turns that into a graph of items with an edge from
+each offered item to the wanted one, so a cycle i1 -> i2 -> ... -> i1 is a ring
+in which the owner of each item gives it away and gets the next one. Only
+cycles of distinct users and at most max_length items are kept.
+
+Items are numbered as they appear and the graph is kept in arrays indexed by
+those numbers. Once no pending offer mentions an item its number is freed for
+the next new item, and users likewise, so the graph only ever holds the items
+and users of pending offers. It is built once per process from the pending
+offers and then follows the offers collection through OfferNotifier, so offers
+made, answered or deleted in any worker add or remove their edges and only the
+cycles through those edges are searched or dropped. Deleting or trading an
+item deletes or rejects its pending offers, which takes the item out as well.
+
+Suggestions can be stale for a moment (an item may have been traded in the
+meantime), so pages showing them check the items first. Run this file to count
+the rings in the database:
+
+    python matching.py --length 4
+"""
+
+import argparse
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+DEFAULT_MAX_LENGTH = 4
+MIN_LENGTH = 3
+# fields of an offer apply() needs
+OFFER_FIELDS = ("status", "offerforid", "offereditems", "sentby", "sendtouser")
+
+
+def _rotate(nodes):
+    # the same cycle always starts at its smallest node
+    start = nodes.index(min(nodes))
+    return tuple(nodes[start:] + nodes[:start])
+
+
+class TradeGraph:
+    """
+    Want/have graph of the pending offers and the trade cycles in it
+    """
+
+    def __init__(self, max_length=DEFAULT_MAX_LENGTH):
+        self.max_length = max_length
+        self._nodes = {}  # item id -> node number
+        self._items = []  # node number -> item id
+        self._owners = array("l")  # node number -> user number, -1 if unknown
+        self._refs = array("l")  # node number -> pending offers mentioning it
+        self._free_nodes = []  # numbers of nodes no offer mentions any more
+        self._user_nodes = defaultdict(set)  # user number -> node numbers
+        self._user_numbers = {}  # user id -> user number
+        self._users = []  # user number -> user id
+        self._free_users = []
+        self._out = []  # node number -> array of target nodes, one per offer
+        self._offers = {}  # offer id -> (wanted node, offered nodes)
+        self._cycles = set()
+        self._cycles_by_node = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._offers)
+
+    def _user(self, user_id):
+        key = str(user_id)
+        number = self._user_numbers.get(key)
+        if number is None:
+            if self._free_users:
+                number = self._free_users.pop()
+                self._users[number] = key
+            else:
+                number = len(self._users)
+                self._users.append(key)
+            self._user_numbers[key] = number
+        return number
+
+    def _node(self, item_id, owner):
+        key = str(item_id)
+        node = self._nodes.get(key)
+        if node is None:
+            if self._free_nodes:
+                # freed nodes have no edges, no owner and no references left
+                node = self._free_nodes.pop()
+                self._items[node] = key
+            else:
+                node = len(self._items)
+                self._items.append(key)
+                self._owners.append(-1)
+                self._refs.append(0)
+                self._out.append(array("l"))
+            self._nodes[key] = node
+        if owner is not None and self._owners[node] == -1:
+            self._owners[node] = self._user(owner)
+            self._user_nodes[self._owners[node]].add(node)
+        return node
+
+    def _release(self, node):
+        # one offer less mentions node, forget the item once none does
+        self._refs[node] -= 1
+        if self._refs[node]:
+            return
+        del self._nodes[self._items[node]]
+        self._items[node] = None
+        owner = self._owners[node]
+        if owner != -1:
+            self._owners[node] = -1
+            nodes = self._user_nodes[owner]
+            nodes.discard(node)
+            if not nodes:
+                del self._user_nodes[owner]
+                del self._user_numbers[self._users[owner]]
+                self._users[owner] = None
+                self._free_users.append(owner)
+        self._free_nodes.append(node)
+
+    def _add_cycle(self, nodes):
+        cycle = _rotate(nodes)
+        if cycle in self._cycles:
+            return False
+        self._cycles.add(cycle)
+        for node in cycle:
+            self._cycles_by_node[node].add(cycle)
+        return True
+
+    def _drop_edge_cycles(self, source, target):
+        # the cycles that went from source straight to target
+        for cycle in list(self._cycles_by_node.get(source, ())):
+            position = cycle.index(source)
+            if cycle[(position + 1) % len(cycle)] != target:
+                continue
+            self._cycles.discard(cycle)
+            for node in cycle:
+                self._cycles_by_node[node].discard(cycle)
+                if not self._cycles_by_node[node]:
+                    del self._cycles_by_node[node]
+
+    def _paths(self, start, end, min_node=-1):
+        """
+        Yields the simple paths start -> ... -> end with distinct owners and at most
+        max_length nodes, through nodes above min_node only
+        """
+        owners = self._owners
+        # end is one more node on the cycle, unless the path goes back to start
+        closing = int(end != start)
+        path = [start]
+        seen_owners = {owners[start]}
+        stack = [iter(self._out[start])]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                seen_owners.discard(owners[path.pop()])
+                continue
+            if node == end:
+                if len(path) + closing >= MIN_LENGTH and (
+                    not closing or owners[end] not in seen_owners
+                ):
+                    yield path + [end]
+                continue
+            if (
+                node <= min_node
+                or node in path
+                or owners[node] in seen_owners
+                or len(path) + 1 + closing > self.max_length
+            ):
+                continue
+            path.append(node)
+            seen_owners.add(owners[node])
+            stack.append(iter(self._out[node]))
+
+    def add_offer(self, offer, search=True):
+        """
+        Adds the edges of a pending offer. Returns the number of new cycles found,
+        or 0 without searching if search is False.
+        """
+        offer_id = str(offer["_id"])
+        offered_ids = offer.get("offereditems") or []
+        if not offer.get("offerforid") or not offered_ids:
+            return 0
+        found = 0
+        with self._lock:
+            if offer_id in self._offers:
+                return 0
+            wanted = self._node(offer["offerforid"], offer.get("sendtouser"))
+            offered = [self._node(item, offer.get("sentby")) for item in offered_ids]
+            self._offers[offer_id] = (wanted, offered)
+            for node in [wanted] + offered:
+                self._refs[node] += 1
+            for node in offered:
+                self._out[node].append(wanted)
+                if search:
+                    # new cycles all use the new edge node -> wanted
+                    for path in self._paths(wanted, node):
+                        found += self._add_cycle([node] + path[:-1])
+        return found
+
+    def remove_offer(self, offer_id):
+        """
+        Removes the edges of an offer and the cycles that needed them
+        """
+        with self._lock:
+            entry = self._offers.pop(str(offer_id), None)
+            if entry is None:
+                return
+            wanted, offered = entry
+            for node in offered:
+                edges = self._out[node]
+                edges.remove(wanted)
+                if wanted not in edges:
+                    self._drop_edge_cycles(node, wanted)
+            for node in [wanted] + offered:
+                self._release(node)
+
+    def apply(self, offer):
+        """
+        Brings the graph up to date with one offer document, pending or not
+        """
+        if offer.get("status") == "sent":
+            self.add_offer(offer)
+        else:
+            self.remove_offer(offer["_id"])
+
+    def match(self):
+        """
+        Finds every cycle from scratch. Returns the number of cycles.
+        """
+        with self._lock:
+            self._cycles.clear()
+            self._cycles_by_node.clear()
+            # nodes nothing points at cannot be on a cycle
+            targets = set()
+            for edges in self._out:
+                targets.update(edges)
+            for start in sorted(targets):
+                if not self._out[start]:
+                    continue
+                # each cycle is found once, from its smallest node
+                for path in self._paths(start, start, min_node=start):
+                    self._add_cycle(path[:-1])
+            return len(self._cycles)
+
+    def load(self, offers):
+        """
+        Adds every pending offer in offers and matches them all at once
+        """
+        for offer in offers:
+            if offer.get("status", "sent") == "sent":
+                self.add_offer(offer, search=False)
+        return self.match()
+
+    def cycles_for(self, user_id, limit=None):
+        """
+        Returns the cycles user_id takes part in, shortest first, each as a list of
+        (item id, owner id) in which every owner gets the item after their own
+        """
+        with self._lock:
+            number = self._user_numbers.get(str(user_id))
+            if number is None:
+                return []
+            cycles = set()
+            for node in self._user_nodes.get(number, ()):
+                cycles.update(self._cycles_by_node.get(node, ()))
+            cycles = sorted(cycles, key=lambda cycle: (len(cycle), cycle))[:limit]
+            return [
+                [(self._items[node], self._users[self._owners[node]]) for node in cycle]
+                for cycle in cycles
+            ]
+
+    def count(self):
+        with self._lock:
+            return len(self._cycles)
+
+    def item_count(self):
+        """
+        Returns the number of items the pending offers mention
+        """
+        with self._lock:
+            return len(self._nodes)
+
+
+def load_offers(db):
+    """
+    Returns the pending offers of db with the fields TradeGraph needs
+    """
+    return db.offers.find({"status": "sent"}, dict.fromkeys(OFFER_FIELDS, 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count the trade rings.")
+    parser.add_argument("--length", type=int, default=DEFAULT_MAX_LENGTH)
+    args = parser.parse_args()
+
+    from app import db
+
+    graph = TradeGraph(args.length)
+    start = time.perf_counter()
+    count = graph.load(load_offers(db))
+    print(
+        " * Found %d rings in %d offers in %.2f s"
+        % (count, len(graph), time.perf_counter() - start)
+    )
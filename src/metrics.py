@@ -0,0 +1,259 @@
+"""
+Per-request timing and MongoDB command instrumentation, exported in the
+Prometheus text format on /metrics.
+
+Metrics.init_app hooks into every request to record the route, status, total
+latency and time spent rendering templates. Metrics.command_listener is a
+pymongo CommandListener that counts and times every MongoDB command, both in
+total and for the request that issued it, and logs commands slower than
+SLOW_QUERY_MS.
+
+The numbers are kept per process, so with several gunicorn workers each
+scrape only sees the worker that answered it.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import before_render_template, g, request, template_rendered
+from pymongo import monitoring
+
+log = logging.getLogger("campusswap.metrics")
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# longest command summary written to the slow query log
+MAX_SUMMARY_LENGTH = 500
+
+# [commands, seconds] of the request being handled on this thread
+_request_commands = contextvars.ContextVar("request_commands", default=None)
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, like a Prometheus histogram
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+
+def _labels(**labels):
+    pairs = ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _summary(event):
+    # the part of a command worth logging, never the documents being written
+    command = event.command
+    name = event.command_name
+    collection = command.get(name)
+    if name == "find":
+        detail = command.get("filter")
+    elif name == "aggregate":
+        detail = command.get("pipeline")
+    elif name in ("count", "distinct"):
+        detail = command.get("query")
+    else:
+        detail = None
+    text = "%s %s.%s %r" % (name, event.database_name, collection, detail)
+    return text[:MAX_SUMMARY_LENGTH]
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Counts and times MongoDB commands for a Metrics instance
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._started = {}
+
+    def started(self, event):
+        if self.metrics.slow_query_seconds is not None:
+            self._started[(event.connection_id, event.request_id)] = _summary(event)
+
+    def _finished(self, event, failed):
+        seconds = event.duration_micros / 1e6
+        summary = self._started.pop((event.connection_id, event.request_id), None)
+        self.metrics.observe_command(event.command_name, seconds, failed)
+        current = _request_commands.get()
+        if current is not None:
+            current[0] += 1
+            current[1] += seconds
+        slow = self.metrics.slow_query_seconds
+        if slow is not None and seconds >= slow:
+            log.warning("slow query (%.1f ms): %s", seconds * 1000, summary)
+
+    def succeeded(self, event):
+        self._finished(event, False)
+
+    def failed(self, event):
+        self._finished(event, True)
+
+
+class Metrics:
+    """
+    Collects request and MongoDB metrics and renders them for Prometheus
+    """
+
+    def __init__(self, slow_query_ms=None):
+        if slow_query_ms is None:
+            slow_query_ms = float(os.getenv("SLOW_QUERY_MS", "100"))
+        # a negative threshold turns the slow query log off
+        self.slow_query_seconds = slow_query_ms / 1000 if slow_query_ms >= 0 else None
+        self.command_listener = CommandTimer(self)
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)  # (route, method, status) -> count
+        self._latency = defaultdict(Histogram)  # route -> request latency
+        self._render = defaultdict(float)  # route -> template seconds
+        self._request_commands = defaultdict(lambda: [0, 0.0])  # route -> [commands, seconds]
+        self._commands = defaultdict(lambda: [0, 0, 0.0])  # name -> [count, failed, seconds]
+        self._gauges = []
+
+    def add_gauges(self, callback):
+        """
+        Registers callback() returning (name, help, {labels tuple: value}) tuples to export with every scrape
+        """
+        self._gauges.append(callback)
+
+    def observe_command(self, name, seconds, failed):
+        with self._lock:
+            stats = self._commands[name]
+            stats[0] += 1
+            stats[1] += int(failed)
+            stats[2] += seconds
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_render = 0.0
+        g.metrics_commands = [0, 0.0]
+        g.metrics_token = _request_commands.set(g.metrics_commands)
+
+    def _before_render(self, sender, template, context, **extra):
+        g.metrics_render_start = time.perf_counter()
+
+    def _after_render(self, sender, template, context, **extra):
+        start = g.pop("metrics_render_start", None)
+        if start is not None:
+            g.metrics_render = g.get("metrics_render", 0.0) + time.perf_counter() - start
+
+    def _after_request(self, response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        status = response.status_code
+        record = (route, request.method, status, start, g._get_current_object())
+        if response.is_streamed:
+            # streamed pages render and query while the body is sent, after this hook
+            response.call_on_close(lambda: self._record(*record))
+        else:
+            self._record(*record)
+        return response
+
+    def _record(self, route, method, status, start, state):
+        elapsed = time.perf_counter() - start
+        render = state.get("metrics_render", 0.0)
+        commands, command_seconds = state.metrics_commands
+        with self._lock:
+            self._requests[(route, method, status)] += 1
+            self._latency[route].observe(elapsed)
+            self._render[route] += render
+            totals = self._request_commands[route]
+            totals[0] += commands
+            totals[1] += command_seconds
+        log.debug(
+            "%s %s %s %.1f ms, render %.1f ms, %d mongo commands in %.1f ms",
+            method,
+            route,
+            status,
+            elapsed * 1000,
+            render * 1000,
+            commands,
+            command_seconds * 1000,
+        )
+
+    def _teardown_request(self, exc):
+        token = g.pop("metrics_token", None)
+        if token is not None:
+            _request_commands.reset(token)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format
+        """
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        with self._lock:
+            header("http_requests_total", "counter", "Requests handled.")
+            for (route, method, status), count in sorted(self._requests.items()):
+                labels = _labels(route=route, method=method, status=status)
+                lines.append("http_requests_total%s %d" % (labels, count))
+
+            header("http_request_duration_seconds", "histogram", "Request latency.")
+            for route, histogram in sorted(self._latency.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    labels = _labels(route=route, le=bound)
+                    lines.append("http_request_duration_seconds_bucket%s %d" % (labels, count))
+                labels = _labels(route=route, le="+Inf")
+                lines.append("http_request_duration_seconds_bucket%s %d" % (labels, histogram.count))
+                labels = _labels(route=route)
+                lines.append("http_request_duration_seconds_sum%s %f" % (labels, histogram.sum))
+                lines.append("http_request_duration_seconds_count%s %d" % (labels, histogram.count))
+
+            header("template_render_seconds_total", "counter", "Time spent rendering templates.")
+            for route, seconds in sorted(self._render.items()):
+                lines.append("template_render_seconds_total%s %f" % (_labels(route=route), seconds))
+
+            header("request_mongo_commands_total", "counter", "MongoDB commands issued by requests.")
+            for route, (count, _) in sorted(self._request_commands.items()):
+                lines.append("request_mongo_commands_total%s %d" % (_labels(route=route), count))
+            header("request_mongo_seconds_total", "counter", "Time requests spent in MongoDB commands.")
+            for route, (_, seconds) in sorted(self._request_commands.items()):
+                lines.append("request_mongo_seconds_total%s %f" % (_labels(route=route), seconds))
+
+            header("mongo_commands_total", "counter", "MongoDB commands by name.")
+            for name, (count, failed, _) in sorted(self._commands.items()):
+                lines.append("mongo_commands_total%s %d" % (_labels(command=name), count))
+            header("mongo_command_failures_total", "counter", "Failed MongoDB commands by name.")
+            for name, (_, failed, _) in sorted(self._commands.items()):
+                lines.append("mongo_command_failures_total%s %d" % (_labels(command=name), failed))
+            header("mongo_command_seconds_total", "counter", "Time spent in MongoDB commands by name.")
+            for name, (_, _, seconds) in sorted(self._commands.items()):
+                lines.append("mongo_command_seconds_total%s %f" % (_labels(command=name), seconds))
+
+        for callback in self._gauges:
+            for name, help_text, values in callback():
+                header(name, "gauge", help_text)
+                for labels, value in sorted(values.items()):
+                    lines.append("%s%s %s" % (name, _labels(**dict(labels)), value))
+        return "\n".join(lines) + "\n"
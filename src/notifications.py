@@ -0,0 +1,300 @@
+"""
+Pushes offer changes to the users they concern as Server-Sent Events.
+
+One thread per web process follows the offers collection and hands every
+insert or status change to the queues of the subscribed users it concerns: a
+new or withdrawn offer goes to the user it was sent to, an accepted, rejected
+or expired offer to the user who sent it. Events carry only the offer id, the
+item it is for and the new status, so the pages can update themselves without
+rerunning the offer query.
+
+On a replica set the thread reads a change stream. A standalone server (like
+the docker-compose one) has no change streams, so the thread falls back to
+polling for offers whose updated_at moved, every POLL_INTERVAL seconds.
+Either way there is one reader per process however many users are connected.
+
+Deleted offers cannot be found by polling, so the code deleting pending offers
+first leaves a tombstone in offer_deletions with record_deletions(). Both
+readers publish those with the "deleted" status. Tombstones expire after an
+hour through a TTL index.
+Other parts of the app can follow the same changes with add_listener().
+"""
+
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
+
+# event name sent for each offer status
+EVENTS = {
+    "sent": "new_offer",
+    "accepted": "acceptoffer",
+    "rejected": "rejectoffer",
+    "withdrawn": "withdrawoffer",
+    "expired": "expireoffer",
+    "deleted": "deleteoffer",
+}
+# statuses announced to the user the offer was sent to, the rest go to its sender
+TO_RECIPIENT = ("sent", "withdrawn", "deleted")
+# fields of a deleted offer kept in its tombstone
+TOMBSTONE_FIELDS = ("sentby", "sendtouser", "offerforid", "offereditems")
+POLL_INTERVAL = 2.0
+# how far back each poll looks again, in case the web servers' clocks disagree
+POLL_OVERLAP = datetime.timedelta(seconds=5)
+RETRY_DELAY = 5.0
+# events kept for a subscriber that is not reading, newer ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+# a stream ends after this many seconds and the browser reconnects, which frees
+# the server thread of clients that went away without closing the connection
+STREAM_SECONDS = 300
+KEEPALIVE_SECONDS = 15
+RECONNECT_MS = 3000
+# error codes of "The $changeStream stage is only supported on replica sets"
+# and of a resume token that is no longer in the oplog
+CHANGE_STREAMS_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+log = logging.getLogger("campusswap.notifications")
+
+CHANGE_PIPELINE = [
+    {"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}},
+    {
+        "$project": {
+            "operationType": 1,
+            "documentKey": 1,
+            "updateDescription.updatedFields.status": 1,
+            "fullDocument.status": 1,
+            "fullDocument.offerforid": 1,
+            "fullDocument.offereditems": 1,
+            "fullDocument.sentby": 1,
+            "fullDocument.sendtouser": 1,
+        }
+    },
+]
+
+
+def record_deletions(db, offers, session=None):
+    """
+    Leaves a tombstone for each pending offer among offers (documents with the
+    TOMBSTONE_FIELDS) that is about to be deleted, so every process hears of it
+    """
+    now = datetime.datetime.utcnow()
+    tombstones = [
+        UpdateOne(
+            {"_id": offer["_id"]},
+            {
+                "$set": dict(
+                    {field: offer.get(field) for field in TOMBSTONE_FIELDS},
+                    status="deleted",
+                    deleted_at=now,
+                )
+            },
+            upsert=True,
+        )
+        for offer in offers
+        if offer.get("status") == "sent"
+    ]
+    if tombstones:
+        db.offer_deletions.bulk_write(tombstones, ordered=False, session=session)
+
+
+def offer_event(offer):
+    """
+    Returns (user id to notify, event name, data) for an offer document,
+    or None if its status has no event
+    """
+    status = offer.get("status")
+    if status not in EVENTS:
+        return None
+    recipient = offer.get("sendtouser" if status in TO_RECIPIENT else "sentby")
+    if recipient is None:
+        return None
+    data = {
+        "offer": str(offer["_id"]),
+        "offerforid": str(offer.get("offerforid")),
+        "status": status,
+    }
+    return str(recipient), EVENTS[status], data
+
+
+class OfferNotifier:
+    """
+    Follows the offers collection and delivers offer_event()s to subscribers
+    """
+
+    def __init__(self, db, poll_interval=POLL_INTERVAL, max_subscribers=None):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.max_subscribers = max_subscribers
+        self._subscribers = {}  # user id -> set of queues
+        self._listeners = []
+        self._count = 0
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._resume_token = None
+
+    def start(self):
+        """
+        Starts following the offers collection in this process, if it is not yet.
+        The first subscriber starts it otherwise.
+        """
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def subscribe(self, user_id):
+        """
+        Returns a queue that receives (event name, data) for user_id,
+        or None if max_subscribers are already connected to this process
+        """
+        with self._lock:
+            if self.max_subscribers is not None:
+                if self._count >= self.max_subscribers:
+                    return None
+            self.start()
+            events = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+            self._subscribers.setdefault(str(user_id), set()).add(events)
+            self._count += 1
+            return events
+
+    def unsubscribe(self, user_id, events):
+        with self._lock:
+            queues = self._subscribers.get(str(user_id), set())
+            if events in queues:
+                queues.discard(events)
+                self._count -= 1
+            if not queues:
+                self._subscribers.pop(str(user_id), None)
+
+    def add_listener(self, callback):
+        """
+        Registers callback(offer) to run in the reader thread for every offer change
+        """
+        self._listeners.append(callback)
+
+    def publish(self, offer):
+        """
+        Delivers the event for an offer document to the subscribers it concerns
+        """
+        for callback in self._listeners:
+            try:
+                callback(offer)
+            except Exception:
+                log.exception("offer listener failed")
+        event = offer_event(offer)
+        if event is None:
+            return
+        user_id, name, data = event
+        with self._lock:
+            queues = list(self._subscribers.get(user_id, ()))
+        for events in queues:
+            try:
+                events.put_nowait((name, data))
+            except queue.Full:
+                # a stalled client misses updates rather than holding memory
+                pass
+
+    def _run(self):
+        while True:
+            try:
+                self._watch()
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    log.info("no change streams on this server, polling for offers")
+                    self._poll()
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    self._resume_token = None
+                log.warning("offer change stream failed: %s", e)
+                time.sleep(RETRY_DELAY)
+            except PyMongoError as e:
+                log.warning("offer change stream failed: %s", e)
+                time.sleep(RETRY_DELAY)
+
+    def _watch(self):
+        with self.db.offers.watch(
+            CHANGE_PIPELINE,
+            full_document="updateLookup",
+            resume_after=self._resume_token,
+        ) as stream:
+            for change in stream:
+                self._resume_token = stream.resume_token
+                updated = change.get("updateDescription", {}).get("updatedFields", {})
+                if change["operationType"] == "update" and "status" not in updated:
+                    continue
+                offer_id = change["documentKey"]["_id"]
+                if change["operationType"] == "delete":
+                    # without a tombstone listeners still drop it, no one is told
+                    tombstone = self.db.offer_deletions.find_one({"_id": offer_id})
+                    offer = tombstone or {}
+                else:
+                    offer = dict(change.get("fullDocument") or {})
+                offer["_id"] = offer_id
+                self.publish(offer)
+
+    def _poll(self):
+        fields = ("status",) + TOMBSTONE_FIELDS
+        # (collection, time field, projection) of the offer changes and deletions
+        sources = [
+            (self.db.offers, "updated_at", dict.fromkeys(fields + ("updated_at",), 1)),
+            (self.db.offer_deletions, "deleted_at", None),
+        ]
+        since = [datetime.datetime.utcnow()] * len(sources)
+        seen = [{} for _ in sources]  # offer id -> time already published
+        while True:
+            time.sleep(self.poll_interval)
+            for number, (collection, field, projection) in enumerate(sources):
+                try:
+                    changed = list(
+                        collection.find(
+                            {field: {"$gt": since[number] - POLL_OVERLAP}}, projection
+                        ).sort(field, 1)
+                    )
+                except PyMongoError as e:
+                    log.warning("polling for offer changes failed: %s", e)
+                    continue
+                for offer in changed:
+                    if seen[number].get(offer["_id"]) == offer[field]:
+                        continue
+                    seen[number][offer["_id"]] = offer[field]
+                    self.publish(offer)
+                    since[number] = max(since[number], offer[field])
+                # forget what can no longer come back in the overlap window
+                seen[number] = {
+                    offer_id: changed_at
+                    for offer_id, changed_at in seen[number].items()
+                    if changed_at > since[number] - POLL_OVERLAP
+                }
+
+
+def sse(name, data):
+    """
+    Formats one Server-Sent Event
+    """
+    return "event: %s\ndata: %s\n\n" % (name, json.dumps(data))
+
+
+def event_stream(notifier, user_id, events, seconds=STREAM_SECONDS):
+    """
+    Yields the Server-Sent Events of a subscription for seconds, then unsubscribes
+    """
+    deadline = time.monotonic() + seconds
+    try:
+        yield "retry: %d\n\n" % RECONNECT_MS
+        while time.monotonic() < deadline:
+            try:
+                name, data = events.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                # a comment line, keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                continue
+            yield sse(name, data)
+    finally:
+        notifier.unsubscribe(user_id, events)
@@ -0,0 +1,360 @@
+"""
+Offers: loading them together with their items, and moving them through their
+lifecycle.
+
+Offers store the wanted item in "offerforid" and the offered items in
+"offereditems" as id strings. hydrate_offers replaces those ids with the item
+details in one aggregation, so the sent and received offer pages (and anything
+else that lists offers) share one query.
+
+An offer is "sent" until the user it was sent to accepts or rejects it, the
+sender withdraws it, or it expires. Each of those is one find_one_and_update
+that only matches a sent offer of the right user, so when two requests race
+only one of them wins and the other gets an OfferError.
+
+Accepting an offer trades its items: the wanted and offered items get the
+offer's id in traded_in and are taken off the feed, and every other pending
+offer for or with one of them is rejected in the same bulk write. On a replica
+set all of it is one transaction; on a standalone server an accept that loses
+the race for an item puts back what it changed before raising.
+"""
+
+import datetime
+import logging
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument, UpdateMany
+
+from database import run_transaction, start_periodic
+from pagination import DEFAULT_PAGE_SIZE, keyset_page
+from profiles import adjust, pending_by_recipient
+
+OFFER_STATUSES = ("sent", "accepted", "rejected", "withdrawn", "expired")
+# status -> the statuses an offer can move to from it, anything else is final
+TRANSITIONS = {"sent": ("accepted", "rejected", "withdrawn", "expired")}
+# who may make each transition, expiry is done by expire_offers for everyone
+ACTORS = {"accepted": "sendtouser", "rejected": "sendtouser", "withdrawn": "sentby"}
+
+log = logging.getLogger("campusswap.offers")
+# the item fields the offer templates use
+OFFER_ITEM_FIELDS = ("name", "username", "user", "image_url", "image")
+
+
+def _find_item(item_id):
+    # the looked up item whose _id matches the id string item_id
+    return {
+        "$arrayElemAt": [
+            {
+                "$filter": {
+                    "input": "$_items",
+                    "as": "item",
+                    "cond": {"$eq": [{"$toString": "$$item._id"}, item_id]},
+                }
+            },
+            0,
+        ]
+    }
+
+
+# runs on one page of offers and swaps the item ids for the items
+HYDRATE_PIPELINE = [
+    {
+        "$addFields": {
+            "_item_ids": {
+                "$map": {
+                    "input": {
+                        "$concatArrays": [
+                            ["$offerforid"],
+                            {"$ifNull": ["$offereditems", []]},
+                        ]
+                    },
+                    "as": "id",
+                    "in": {
+                        "$convert": {
+                            "input": "$$id",
+                            "to": "objectId",
+                            "onError": None,
+                            "onNull": None,
+                        }
+                    },
+                }
+            }
+        }
+    },
+    {
+        "$lookup": {
+            "from": "items",
+            "localField": "_item_ids",
+            "foreignField": "_id",
+            "as": "_items",
+        }
+    },
+    {
+        "$project": {
+            "status": 1,
+            "sentby": 1,
+            "sendtouser": 1,
+            "_items": {
+                "$map": {
+                    "input": "$_items",
+                    "as": "item",
+                    "in": dict(
+                        {"_id": "$$item._id"},
+                        **{field: "$$item." + field for field in OFFER_ITEM_FIELDS}
+                    ),
+                }
+            },
+            "offerforid": 1,
+            "offereditems": {"$ifNull": ["$offereditems", []]},
+        }
+    },
+    {
+        "$project": {
+            "status": 1,
+            "sentby": 1,
+            "sendtouser": 1,
+            "offerforid": _find_item("$offerforid"),
+            "offereditems": {
+                "$map": {
+                    "input": "$offereditems",
+                    "as": "offered",
+                    "in": _find_item("$$offered"),
+                }
+            },
+        }
+    },
+]
+
+
+def hydrate_offers(
+    db,
+    query,
+    status=None,
+    after=None,
+    before=None,
+    limit=DEFAULT_PAGE_SIZE,
+    stream=False,
+):
+    """
+    Returns a pagination.Page of the offers matching query, newest first, with
+    offerforid and offereditems replaced by the items they point to.
+    status limits the page to one of OFFER_STATUSES, anything else is ignored.
+    stream is passed on to keyset_page.
+    """
+    if status in OFFER_STATUSES:
+        query = dict(query, status=status)
+    return keyset_page(
+        db.offers,
+        query,
+        "_id",
+        -1,
+        after=after,
+        before=before,
+        limit=limit,
+        pipeline=HYDRATE_PIPELINE,
+        stream=stream,
+    )
+
+
+class OfferError(Exception):
+    """
+    An offer cannot be made or moved to the requested status
+    """
+
+
+def _object_id(value):
+    if not ObjectId.is_valid(value):
+        raise OfferError("There is no such offer")
+    return ObjectId(value)
+
+
+def send_offer(db, item_id, offered, user_id):
+    """
+    Creates a sent offer of the offered item ids of user_id for item_id and counts
+    it as pending for the item's owner. Returns the offer.
+    Raises OfferError unless every item exists and is untraded, the wanted item
+    belongs to someone else and the offered ones to user_id.
+    """
+    user_id = ObjectId(user_id)
+    if not offered:
+        raise OfferError("Choose at least one of your items to offer")
+    ids = [item_id] + list(offered)
+    if not all(ObjectId.is_valid(value) for value in ids):
+        raise OfferError("One of these items does not exist")
+    items = {
+        str(item["_id"]): item
+        for item in db.items.find(
+            {"_id": {"$in": [ObjectId(value) for value in ids]}},
+            {"user": 1, "traded_in": 1},
+        )
+    }
+    wanted = items.get(item_id)
+    if wanted is None or any(value not in items for value in offered):
+        raise OfferError("One of these items does not exist")
+    if any("traded_in" in item for item in items.values()):
+        raise OfferError("One of these items has already been traded")
+    if wanted.get("user") == user_id:
+        raise OfferError("You cannot make an offer for your own item")
+    if any(items[value].get("user") != user_id for value in offered):
+        raise OfferError("You can only offer your own items")
+    offer = {
+        "offerforid": item_id,
+        "offereditems": list(offered),
+        "sentby": user_id,
+        "status": "sent",
+        "sendtouser": wanted.get("user"),
+        "updated_at": datetime.datetime.utcnow(),
+    }
+    db.offers.insert_one(offer)
+    adjust(db, offer["sendtouser"], offers_pending=1)
+    return offer
+
+
+def transition(db, offer_id, status, user_id, session=None):
+    """
+    Moves a sent offer of user_id to status in one conditional update, user_id being
+    the recipient for accepted and rejected and the sender for withdrawn.
+    Returns the updated offer, raises OfferError if it was not a sent offer of user_id.
+    """
+    if status not in ACTORS:
+        raise OfferError("Offers cannot be %s by hand" % status)
+    offer = db.offers.find_one_and_update(
+        {
+            "_id": _object_id(offer_id),
+            "status": "sent",
+            ACTORS[status]: ObjectId(user_id),
+        },
+        {"$set": {"status": status, "updated_at": datetime.datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+    if offer is None:
+        raise OfferError("This offer has already been answered or withdrawn")
+    adjust(db, offer["sendtouser"], session=session, offers_pending=-1)
+    return offer
+
+
+def reject_offer(db, offer_id, user_id):
+    return transition(db, offer_id, "rejected", user_id)
+
+
+def withdraw_offer(db, offer_id, user_id):
+    return transition(db, offer_id, "withdrawn", user_id)
+
+
+def _offers_with_items(item_ids):
+    # every offer that wants or offers one of item_ids, which are id strings
+    return {
+        "$or": [
+            {"offerforid": {"$in": item_ids}},
+            {"offereditems": {"$in": item_ids}},
+        ]
+    }
+
+
+def accept_offer(db, offer_id, user_id):
+    """
+    Accepts a sent offer to user_id, marks its items traded and rejects every other
+    pending offer involving them. Returns the accepted offer.
+    Raises OfferError if the offer is not pending or an item is gone or traded.
+    db must be a pymongo Database, see database.run_transaction.
+    """
+
+    def accept(session=None):
+        now = datetime.datetime.utcnow()
+        offer = transition(db, offer_id, "accepted", user_id, session=session)
+        item_ids = [offer["offerforid"]] + list(offer.get("offereditems", []))
+        object_ids = [ObjectId(value) for value in set(item_ids)]
+
+        claimed = db.items.update_many(
+            {"_id": {"$in": object_ids}, "traded_in": {"$exists": False}},
+            {"$set": {"traded_in": offer["_id"]}},
+            session=session,
+        )
+        if claimed.modified_count != len(object_ids):
+            if session is None:
+                # no transaction to abort, put the offer and the items back
+                db.items.update_many(
+                    {"traded_in": offer["_id"]}, {"$unset": {"traded_in": ""}}
+                )
+                db.offers.update_one(
+                    {"_id": offer["_id"]},
+                    {"$set": {"status": "sent", "updated_at": now}},
+                )
+                adjust(db, offer["sendtouser"], offers_pending=1)
+            raise OfferError("One of the items in this offer is gone or already traded")
+
+        # traded items leave the feed
+        public = {}
+        for item in db.items.find(
+            {"_id": {"$in": object_ids}, "public": True}, {"user": 1}, session=session
+        ):
+            public[item["user"]] = public.get(item["user"], 0) + 1
+        if public:
+            db.items.update_many(
+                {"_id": {"$in": object_ids}},
+                {"$set": {"public": False, "updated_at": now}},
+                session=session,
+            )
+
+        competing = {
+            "$and": [
+                {"_id": {"$ne": offer["_id"]}, "status": "sent"},
+                _offers_with_items([str(value) for value in object_ids]),
+            ]
+        }
+        pending = pending_by_recipient(db, competing, session=session)
+        if pending:
+            db.offers.bulk_write(
+                [
+                    UpdateMany(
+                        competing, {"$set": {"status": "rejected", "updated_at": now}}
+                    )
+                ],
+                session=session,
+            )
+        for owner, count in public.items():
+            adjust(db, owner, session=session, public=-count)
+        for recipient, count in pending.items():
+            adjust(db, recipient, session=session, offers_pending=-count)
+        return offer
+
+    return run_transaction(db, accept)
+
+
+def expire_offers(db, max_age):
+    """
+    Expires the offers that are still sent max_age (a timedelta) after they were made.
+    Returns the number of offers expired.
+    """
+    now = datetime.datetime.utcnow()
+    query = {"status": "sent", "_id": {"$lt": ObjectId.from_datetime(now - max_age)}}
+    pending = {}
+    expired = 0
+    for offer in db.offers.find(query, {"_id": 1}):
+        # one at a time, so an offer answered since the find is neither
+        # expired nor taken off its recipient's counter
+        changed = db.offers.find_one_and_update(
+            {"_id": offer["_id"], "status": "sent"},
+            {"$set": {"status": "expired", "updated_at": now}},
+            projection={"sendtouser": 1},
+        )
+        if changed is None:
+            continue
+        expired += 1
+        recipient = changed.get("sendtouser")
+        if recipient is not None:
+            pending[recipient] = pending.get(recipient, 0) + 1
+    for recipient, count in pending.items():
+        adjust(db, recipient, offers_pending=-count)
+    return expired
+
+
+def start_expiry(db, max_age, interval):
+    """
+    Starts a daemon thread that expires old offers every interval seconds
+    """
+
+    return start_periodic(
+        interval, lambda: expire_offers(db, max_age), log, "expiring offers"
+    )
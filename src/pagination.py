@@ -0,0 +1,189 @@
+"""
+Keyset (cursor) pagination helpers for MongoDB queries.
+
+Instead of skipping over every earlier result, each page remembers the sort
+value and _id of its first and last document and the next query starts right
+after (or before) them, so every page costs the same no matter how deep it is.
+
+keyset_page(..., stream=True) returns a StreamedPage instead, whose documents
+are read from the database STREAM_BATCH_SIZE at a time while a streamed
+template iterates them, so the top of the page is sent before the query is done.
+"""
+
+import base64
+import datetime
+from collections import namedtuple
+
+from bson import json_util
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+# documents fetched per round trip while streaming a page
+STREAM_BATCH_SIZE = 20
+# what a sort value in a cursor may be, anything else (a dict of query operators
+# in particular) is refused
+CURSOR_VALUE_TYPES = (
+    type(None), bool, int, float, str, datetime.datetime, ObjectId, Decimal128
+)
+
+# docs holds the documents for this page, in display order. next_cursor and
+# prev_cursor are opaque url-safe strings, or None when there is no such page.
+# limit is the page size the page was fetched with, for the links to its neighbours.
+Page = namedtuple("Page", ["docs", "next_cursor", "prev_cursor", "limit"])
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised by keyset_page when after or before is not a cursor it made
+    """
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    """
+    Turns a page size taken from the query string into a number between 1 and MAX_PAGE_SIZE
+    """
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def encode_cursor(doc, key):
+    """
+    Builds an opaque cursor pointing at doc for a query sorted on key
+    """
+    raw = json_util.dumps([doc.get(key), doc["_id"]])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    """
+    Returns the (value, _id) pair stored in a cursor, or None if the cursor is missing or invalid
+    """
+    if not token:
+        return None
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        value, last_id = json_util.loads(base64.urlsafe_b64decode(padded).decode("utf-8"))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(last_id, ObjectId) or not isinstance(value, CURSOR_VALUE_TYPES):
+        return None
+    return value, last_id
+
+
+class StreamedPage:
+    """
+    A Page whose docs is an iterator reading the results as they are used.
+    next_cursor and prev_cursor are only known once docs has been iterated, so
+    templates must use them after their loop over docs.
+    """
+
+    def __init__(self, results, key, limit, after):
+        self.next_cursor = None
+        self.prev_cursor = None
+        self.limit = limit
+        self.docs = self._iterate(results, key, limit, after)
+
+    def _iterate(self, results, key, limit, after):
+        last = None
+        try:
+            for count, doc in enumerate(results):
+                if count == limit:
+                    # one more than the page holds, so there is a next page
+                    self.next_cursor = encode_cursor(last, key)
+                    break
+                if count == 0 and after:
+                    self.prev_cursor = encode_cursor(doc, key)
+                last = doc
+                yield doc
+        finally:
+            results.close()
+
+
+def _boundary(key, order, cursor, forward):
+    # documents strictly past the cursor in the direction we are walking,
+    # using _id to break ties between equal sort values
+    value, last_id = cursor
+    op = "$gt" if (order == 1) == forward else "$lt"
+    if key == "_id":
+        return {"_id": {op: last_id}}
+    return {"$or": [{key: {op: value}}, {key: value, "_id": {op: last_id}}]}
+
+
+def _sort_keys(key, direction):
+    if key == "_id":
+        return [("_id", direction)]
+    return [(key, direction), ("_id", direction)]
+
+
+def keyset_page(
+    collection,
+    query,
+    key,
+    order,
+    projection=None,
+    after=None,
+    before=None,
+    limit=DEFAULT_PAGE_SIZE,
+    pipeline=None,
+    stream=False,
+):
+    """
+    Fetches one page of collection.find(query) sorted on (key, _id) in the given order.
+
+    Pass the next_cursor of a page as after to get the page following it, or the
+    prev_cursor as before to get the page preceding it. At most limit + 1
+    documents are read from the database.
+
+    If pipeline is given the page is fetched with an aggregation instead, and the
+    pipeline stages run on the page after it has been matched, sorted and limited.
+    projection is ignored in that case, use a $project stage instead.
+
+    With stream=True a page after a cursor (or the first page) is returned as a
+    StreamedPage. Pages before a cursor are read backwards and always read at once.
+    Raises InvalidCursor if after or before cannot be decoded.
+    """
+    forward = not before
+    cursor = decode_cursor(before or after)
+    if (before or after) and cursor is None:
+        raise InvalidCursor("invalid page cursor")
+
+    filters = query
+    if cursor:
+        filters = {"$and": [query, _boundary(key, order, cursor, forward)]}
+
+    direction = order if forward else -order
+    stream = stream and forward
+    batch_size = STREAM_BATCH_SIZE if stream else limit + 1
+    if pipeline is None:
+        results = (
+            collection.find(filters, projection)
+            .sort(_sort_keys(key, direction))
+            .limit(limit + 1)
+            .batch_size(batch_size)
+        )
+    else:
+        stages = [
+            {"$match": filters},
+            {"$sort": dict(_sort_keys(key, direction))},
+            {"$limit": limit + 1},
+        ]
+        results = collection.aggregate(stages + pipeline, batchSize=batch_size)
+    if stream:
+        return StreamedPage(results, key, limit, cursor is not None)
+    docs = list(results)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+
+    if forward:
+        next_cursor = encode_cursor(docs[-1], key) if has_more else None
+        prev_cursor = encode_cursor(docs[0], key) if cursor and docs else None
+    else:
+        docs.reverse()
+        prev_cursor = encode_cursor(docs[0], key) if has_more else None
+        next_cursor = encode_cursor(docs[-1], key) if docs else None
+    return Page(docs, next_cursor, prev_cursor, limit)
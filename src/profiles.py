@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Per-user summary counters and paginated profile listings.
+
+Every user document has a stats sub-document counting the user's listings,
+public listings, pending offers received and friends. The routes that change
+any of these adjust the counter with $inc right after the write (inside the
+same transaction when deleting an item), so a profile page reads one small
+document instead of counting the collections.
+
+Users created before the counters existed get them from recount() the first
+time their profile is shown. Run this file to rebuild every user's counters,
+for example after restoring a backup:
+
+    python profiles.py
+"""
+
+from bson.objectid import ObjectId
+
+from pagination import keyset_page
+
+STATS = ("listings", "public", "offers_pending", "friends")
+PROFILE_PAGE_SIZE = 12
+# only the fields the listing cards on the profile pages use
+PROFILE_PROJECTION = {
+    "name": 1,
+    "description": 1,
+    "price": 1,
+    "image_url": 1,
+    "image": 1,
+    "created_at": 1,
+}
+
+
+def empty_stats():
+    return dict.fromkeys(STATS, 0)
+
+
+def adjust(db, user_id, session=None, **changes):
+    """
+    Adds changes (e.g. listings=1, public=-1) to the counters of user_id in one $inc.
+    Users without counters are left alone, user_stats() counts them when needed.
+    """
+    inc = {"stats." + name: change for name, change in changes.items() if change}
+    if inc:
+        db.users.update_one(
+            {"_id": ObjectId(user_id), "stats": {"$exists": True}},
+            {"$inc": inc},
+            session=session,
+        )
+
+
+def pending_by_recipient(db, query, session=None):
+    """
+    Returns {user id: count} of the pending offers matching query,
+    grouped by the user they were sent to
+    """
+    pipeline = [
+        {"$match": {"$and": [query, {"status": "sent"}]}},
+        {"$group": {"_id": "$sendtouser", "count": {"$sum": 1}}},
+    ]
+    return {
+        group["_id"]: group["count"]
+        for group in db.offers.aggregate(pipeline, session=session)
+        if group["_id"] is not None
+    }
+
+
+def repair_pending(db):
+    """
+    Sets offers_pending of every user whose counter disagrees with their pending
+    offers. On a standalone server the offer writes and the counter updates are
+    not one transaction, so a failure or a race in between leaves them apart.
+    Returns the number of users fixed.
+    """
+    pending = pending_by_recipient(db, {})
+    users = db.users.find(
+        {
+            "$or": [
+                {"_id": {"$in": list(pending)}},
+                {"stats.offers_pending": {"$ne": 0}},
+            ],
+            "stats": {"$exists": True},
+        },
+        {"stats.offers_pending": 1},
+    )
+    fixed = 0
+    for user in users:
+        stored = user["stats"].get("offers_pending", 0)
+        actual = pending.get(user["_id"], 0)
+        if stored != actual:
+            # only if no write moved the counter since it was read
+            fixed += db.users.update_one(
+                {"_id": user["_id"], "stats.offers_pending": stored},
+                {"$set": {"stats.offers_pending": actual}},
+            ).modified_count
+    return fixed
+
+
+def recount(db, user_id):
+    """
+    Rebuilds the counters of user_id from the collections and returns them
+    """
+    user_id = ObjectId(user_id)
+    user = db.users.find_one({"_id": user_id}, {"friends": 1})
+    stats = {
+        "listings": db.items.count_documents({"user": user_id}),
+        "public": db.items.count_documents({"user": user_id, "public": True}),
+        "offers_pending": db.offers.count_documents(
+            {"sendtouser": user_id, "status": "sent"}
+        ),
+        "friends": len(user.get("friends", [])) if user else 0,
+    }
+    db.users.update_one({"_id": user_id}, {"$set": {"stats": stats}})
+    return stats
+
+
+def user_stats(db, user_id):
+    """
+    Returns the counters of user_id, counting them first if the user has none yet
+    """
+    user = db.users.find_one({"_id": ObjectId(user_id)}, {"stats": 1})
+    if user is None:
+        return empty_stats()
+    if "stats" not in user:
+        return recount(db, user_id)
+    return dict(empty_stats(), **user["stats"])
+
+
+def profile_items(
+    db, user_id, after=None, before=None, limit=PROFILE_PAGE_SIZE, stream=False
+):
+    """
+    Returns one Page of the public listings of user_id, newest first.
+    stream is passed on to keyset_page.
+    """
+    return keyset_page(
+        db.items,
+        {"user": ObjectId(user_id), "public": True},
+        "created_at",
+        -1,
+        projection=PROFILE_PROJECTION,
+        after=after,
+        before=before,
+        limit=limit,
+        stream=stream,
+    )
+
+
+if __name__ == "__main__":
+    from app import db
+
+    count = 0
+    for user in db.users.find({}, {"_id": 1}):
+        recount(db, user["_id"])
+        count += 1
+    print(" * Recounted", count, "users")
@@ -0,0 +1,285 @@
+"""
+Per-IP and per-user rate limits and per-route-class concurrency caps.
+
+Routes are grouped into classes by what they cost (ROUTE_CLASSES): logins and
+sign ups run bcrypt, writes start transactions and uploads, and the feed and
+search run the biggest queries. Before a request of a limited class runs,
+RateLimiter takes a token from the bucket of the client's IP address and from
+the bucket of the user (the logged in user, or the username being logged into).
+An empty bucket answers 429 with a Retry-After header saying when the next
+token is due.
+
+Each class also has a cap on the requests it may run at once in a worker. A
+request over the cap gets a 503 with Retry-After straight away instead of
+waiting for a thread, so a burst of logins or offers cannot take every one of
+the WEB_THREADS threads and the cheap pages stay fast. Routes outside the
+classes are never limited.
+
+Buckets are kept in memory by default, so every worker counts on its own and a
+client can get up to WEB_WORKERS times the limit. RedisBackend keeps them in
+Redis, shared by every worker and server. If the shared backend fails the
+request is let through.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import flask_login
+from flask import Response, current_app, g, request
+
+log = logging.getLogger("campusswap.ratelimit")
+
+# count requests per seconds, the bucket also holds up to count tokens for bursts
+Rate = namedtuple("Rate", ["count", "seconds"])
+
+# endpoints of each limited class
+ROUTE_CLASSES = {
+    "auth": ("log_in", "sign_up"),
+    "write": (
+        "create_item",
+        "update_item",
+        "import_listings",
+        "new_offer",
+        "acceptoffer",
+        "rejectoffer",
+        "withdrawoffer",
+        "edit_profile",
+        "add_friend",
+    ),
+    "browse": ("home", "search", "api_feed"),
+}
+# classes only limited for some methods, showing the login form is cheap
+METHODS = {"auth": ("POST",)}
+# per IP rate, per user rate, RATE_LIMIT_<CLASS>_IP and RATE_LIMIT_<CLASS>_USER
+DEFAULT_RATES = {
+    "auth": ("20/60", "5/60"),
+    "write": ("60/60", "30/60"),
+    "browse": ("120/60", "60/60"),
+}
+# seconds a request over a concurrency cap is told to wait
+BUSY_RETRY_AFTER = 1
+MEMORY_BUCKETS = 10000
+
+
+def parse_rate(value):
+    """
+    Parses "count/seconds" (e.g. "10/60") into a Rate, or returns None for "" and "0"
+    """
+    if not value or value == "0":
+        return None
+    count, _, seconds = value.partition("/")
+    rate = Rate(int(count), float(seconds or 1))
+    if rate.count < 1 or rate.seconds <= 0:
+        raise ValueError("rate limits look like 10/60, got %r" % value)
+    return rate
+
+
+def _take(tokens, updated, rate, now):
+    # refills the bucket up to now, returns (tokens left, seconds to wait or 0)
+    refill = rate.count / rate.seconds
+    tokens = min(rate.count, tokens + max(now - updated, 0) * refill)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / refill
+
+
+class MemoryBackend:
+    """
+    Token buckets of this process, the least recently used are forgotten past maxsize
+    """
+
+    def __init__(self, maxsize=MEMORY_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, now=None):
+        """
+        Takes a token from the bucket key. Returns 0 if there was one, otherwise
+        the seconds until there is.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (rate.count, now))
+            tokens, wait = _take(tokens, updated, rate, now)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# the same arithmetic as _take, run atomically in Redis
+TAKE_SCRIPT = """
+local count = tonumber(ARGV[1])
+local seconds = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or count
+local updated = tonumber(bucket[2]) or now
+local refill = count / seconds
+tokens = math.min(count, tokens + math.max(now - updated, 0) * refill)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / refill
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(seconds))
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    """
+    Token buckets shared through Redis.
+    Needs the redis package, which is not in requirements.txt.
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, rate, now=None):
+        now = time.time() if now is None else now
+        return float(self._take(keys=[key], args=[rate.count, rate.seconds, now]))
+
+
+class RateLimiter:
+    """
+    Flask extension that applies the rates and concurrency caps of ROUTE_CLASSES
+    """
+
+    def __init__(self, rates=None, concurrency=None, backend=None):
+        self.rates = rates or {}  # class -> (per IP Rate or None, per user Rate or None)
+        self.backend = backend or MemoryBackend()
+        self._classes = {
+            endpoint: name
+            for name, endpoints in ROUTE_CLASSES.items()
+            for endpoint in endpoints
+        }
+        self._gates = {
+            name: threading.BoundedSemaphore(limit)
+            for name, limit in (concurrency or {}).items()
+            if limit
+        }
+        self.rejected = {}  # (class, "rate" or "busy") -> count
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def route_class(self, endpoint, method):
+        """
+        Returns the class a request falls in, or None if it is not limited
+        """
+        name = self._classes.get(endpoint)
+        if name is None or method not in METHODS.get(name, (method,)):
+            return None
+        return name
+
+    def _user_key(self, name):
+        if name == "auth":
+            return request.form.get("fusername") or None
+        if flask_login.current_user.is_authenticated:
+            return str(flask_login.current_user.id)
+        return None
+
+    def wait(self, name):
+        """
+        Takes a token for the current request from the IP and user buckets of class name.
+        Returns 0 if both had one, otherwise the seconds until they would.
+        """
+        ip_rate, user_rate = self.rates.get(name, (None, None))
+        buckets = [(ip_rate, "ip", request.remote_addr)]
+        if user_rate is not None:
+            buckets.append((user_rate, "user", self._user_key(name)))
+        wait = 0.0
+        for rate, kind, value in buckets:
+            if rate is None or value is None:
+                continue
+            key = "rate:%s:%s:%s" % (name, kind, value)
+            try:
+                wait = max(wait, self.backend.take(key, rate))
+            except Exception as e:
+                log.warning("rate limit backend failed, letting the request in: %s", e)
+        return wait
+
+    def _reject(self, name, reason, message, status, retry_after):
+        with self._lock:
+            self.rejected[name, reason] = self.rejected.get((name, reason), 0) + 1
+        return Response(
+            message,
+            status=status,
+            headers={"Retry-After": str(retry_after)},
+            mimetype="text/plain",
+        )
+
+    def _before_request(self):
+        if not current_app.config.get("RATELIMIT_ENABLED", not current_app.testing):
+            return None
+        name = self.route_class(request.endpoint, request.method)
+        if name is None:
+            return None
+        wait = self.wait(name)
+        if wait > 0:
+            return self._reject(
+                name,
+                "rate",
+                "Too many requests, please try again shortly.",
+                429,
+                math.ceil(wait),
+            )
+        gate = self._gates.get(name)
+        if gate is not None:
+            if not gate.acquire(blocking=False):
+                return self._reject(
+                    name,
+                    "busy",
+                    "Server is busy, please try again.",
+                    503,
+                    BUSY_RETRY_AFTER,
+                )
+            g.ratelimit_gate = gate
+        return None
+
+    def _teardown_request(self, exc):
+        gate = g.pop("ratelimit_gate", None)
+        if gate is not None:
+            gate.release()
+
+
+def rate_limiter_from_env():
+    """
+    Builds a RateLimiter configured by RATE_LIMIT_<CLASS>_IP, RATE_LIMIT_<CLASS>_USER,
+    MAX_CONCURRENT_<CLASS> and RATE_LIMIT_REDIS_URL
+    """
+    threads = int(os.getenv("WEB_THREADS", "4"))
+    # leave at least one thread of every worker for the routes that are not limited
+    default_concurrency = {
+        "auth": max(threads // 2, 1),
+        "write": max(threads // 2, 1),
+        "browse": max(threads - 1, 1),
+    }
+    rates = {}
+    concurrency = {}
+    for name, (ip_rate, user_rate) in DEFAULT_RATES.items():
+        suffix = name.upper()
+        rates[name] = (
+            parse_rate(os.getenv("RATE_LIMIT_%s_IP" % suffix, ip_rate)),
+            parse_rate(os.getenv("RATE_LIMIT_%s_USER" % suffix, user_rate)),
+        )
+        concurrency[name] = int(
+            os.getenv("MAX_CONCURRENT_" + suffix, default_concurrency[name])
+        )
+    redis_url = os.getenv("RATE_LIMIT_REDIS_URL")
+    return RateLimiter(
+        rates, concurrency, backend=RedisBackend(redis_url) if redis_url else None
+    )
@@ -0,0 +1,130 @@
+"""
+Full-text search over public item listings.
+
+Matching uses the text index on name and description declared in indexes.py,
+so a search never scans the whole collection. One aggregation returns the
+page of results ranked by relevance together with the total and the facet
+counts for sellers and price ranges.
+"""
+
+from decimal import Decimal, InvalidOperation
+
+from bson.decimal128 import Decimal128
+
+SEARCH_PAGE_SIZE = 24
+# relevance ranking needs skip/limit paging, so deep pages are cut off
+MAX_SEARCH_PAGES = 50
+MAX_QUERY_LENGTH = 200
+# lower bounds of the price ranges shown as facets, the last range is open ended
+PRICE_BUCKETS = [0, 10, 25, 50, 100, 250]
+SELLER_FACETS = 10
+# the fields the result cards use
+SEARCH_PROJECTION = {
+    "name": 1,
+    "description": 1,
+    "price": 1,
+    "image_url": 1,
+    "image": 1,
+    "username": 1,
+    "score": 1,
+}
+
+
+def parse_price(value):
+    """
+    Turns a price from the query string into a Decimal128, or None if it is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        return None
+    if not price.is_finite() or price < 0:
+        return None
+    return Decimal128(price)
+
+
+def search_query(text, min_price=None, max_price=None, seller=None):
+    """
+    Builds the $match filter for a search
+    """
+    query = {"$text": {"$search": text}, "public": True}
+    price = {}
+    if min_price is not None:
+        price["$gte"] = min_price
+    if max_price is not None:
+        price["$lte"] = max_price
+    if price:
+        query["price"] = price
+    if seller:
+        query["username"] = seller
+    return query
+
+
+def search_items(
+    items,
+    text,
+    min_price=None,
+    max_price=None,
+    seller=None,
+    page=0,
+    limit=SEARCH_PAGE_SIZE,
+):
+    """
+    Searches the public listings in the items collection.
+
+    Returns a dict with the page of matching "docs" (best match first), the
+    "total" number of matches, and facet counts: "sellers" as a list of
+    (username, count) and "prices" as a list of (lower bound, upper bound or None, count).
+    """
+    text = (text or "").strip()[:MAX_QUERY_LENGTH]
+    if not text:
+        return {"docs": [], "total": 0, "sellers": [], "prices": []}
+    page = max(0, min(page, MAX_SEARCH_PAGES - 1))
+
+    pipeline = [
+        {"$match": search_query(text, min_price, max_price, seller)},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+        {
+            "$facet": {
+                "docs": [
+                    {"$sort": {"score": -1, "_id": 1}},
+                    {"$skip": page * limit},
+                    {"$limit": limit},
+                    {"$project": SEARCH_PROJECTION},
+                ],
+                "total": [{"$count": "count"}],
+                "sellers": [
+                    {"$group": {"_id": "$username", "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1, "_id": 1}},
+                    {"$limit": SELLER_FACETS},
+                ],
+                "prices": [
+                    {
+                        "$bucket": {
+                            "groupBy": "$price",
+                            "boundaries": PRICE_BUCKETS + [Decimal128("Infinity")],
+                            "default": "other",
+                            "output": {"count": {"$sum": 1}},
+                        }
+                    }
+                ],
+            }
+        },
+    ]
+    result = next(items.aggregate(pipeline), {})
+
+    total = result.get("total") or [{"count": 0}]
+    bounds = dict(zip(PRICE_BUCKETS, PRICE_BUCKETS[1:] + [None]))
+    prices = [
+        (bucket["_id"], bounds[bucket["_id"]], bucket["count"])
+        for bucket in result.get("prices", [])
+        if bucket["_id"] in bounds
+    ]
+    return {
+        "docs": result.get("docs", []),
+        "total": total[0]["count"],
+        "sellers": [(seller["_id"], seller["count"]) for seller in result.get("sellers", [])],
+        "prices": prices,
+    }
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Helpers for the friends graph stored in each user's "friends" array.
+
+Friendship is one way: adding someone puts them in your friends array and
+their listings in your friends feed. Both the feed and the friend suggestions
+are written ahead of time so reading them is one indexed range query however
+many friends a user has:
+
+- friend_feed holds one entry (owner, item, author, created_at) per listing in
+  each user's feed. Publishing a listing fans it out to everyone who has its
+  author as a friend, adding a friend copies in the friend's latest listings,
+  and listings made private or deleted are taken out again. Entries whose
+  listing was traded or removed in some other way are dropped when a page
+  finds them.
+- friend_suggestions holds (user, candidate, mutual) for every friend of a
+  friend of user, mutual being how many of user's friends have candidate as a
+  friend. Adding a friend only increments the pairs it creates.
+
+Run this file to rebuild both collections from the friends arrays and items,
+for example for users who made friends before they existed:
+
+    python social.py
+"""
+
+from collections import Counter
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+
+from pagination import keyset_page
+from profiles import PROFILE_PROJECTION, adjust
+
+FRIENDS_PAGE_SIZE = 50
+# the fields shown for each friend in friends.html
+FRIEND_PROJECTION = {"pic": 1, "image": 1, "username": 1}
+# listings of a new friend copied into the feed
+FEED_BACKFILL = 50
+# feed entries or suggestion counts written per bulk_write
+FANOUT_BATCH_SIZE = 1000
+SUGGESTIONS_SHOWN = 10
+# the fields the listing cards of the friends feed use
+FEED_ITEM_PROJECTION = dict(PROFILE_PROJECTION, username=1)
+
+
+def _write(collection, operations):
+    # runs the operations in unordered batches of FANOUT_BATCH_SIZE
+    for start in range(0, len(operations), FANOUT_BATCH_SIZE):
+        collection.bulk_write(
+            operations[start : start + FANOUT_BATCH_SIZE], ordered=False
+        )
+
+
+def _feed_entry(owner_id, item):
+    entry = {
+        "owner": owner_id,
+        "item": item["_id"],
+        "author": item["user"],
+        "created_at": item["created_at"],
+    }
+    return UpdateOne(
+        {"owner": owner_id, "item": item["_id"]}, {"$setOnInsert": entry}, upsert=True
+    )
+
+
+def followers(db, user_id):
+    """
+    Returns the ids of the users who have user_id as a friend
+    """
+    users = db.users.find({"friends": ObjectId(user_id)}, {"_id": 1})
+    return [user["_id"] for user in users]
+
+
+def publish_items(db, items):
+    """
+    Adds listings (documents with _id, user and created_at) to the friends feeds
+    of the users who have their authors as friends
+    """
+    by_author = {}
+    for item in items:
+        by_author.setdefault(item["user"], []).append(item)
+    for author_id, authored in by_author.items():
+        _write(
+            db.friend_feed,
+            [
+                _feed_entry(owner_id, item)
+                for owner_id in followers(db, author_id)
+                for item in authored
+            ],
+        )
+
+
+def unpublish_items(db, item_ids, session=None):
+    """
+    Takes listings out of every friends feed
+    """
+    db.friend_feed.delete_many(
+        {"item": {"$in": [ObjectId(item_id) for item_id in item_ids]}},
+        session=session,
+    )
+
+
+def add_friend(db, user_id, friend_id):
+    """
+    Appends friend_id to the friends array of user_id unless it is already there,
+    and brings the friends feed and suggestions up to date.
+    Returns True if the friend was added.
+    """
+    user_id = ObjectId(user_id)
+    before = db.users.find_one_and_update(
+        {"_id": user_id, "friends": {"$ne": friend_id}},
+        {"$push": {"friends": friend_id}},
+        {"friends": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if before is None:
+        return False
+    adjust(db, user_id, friends=1)
+    _backfill_feed(db, user_id, friend_id)
+    _add_suggestions(db, user_id, before.get("friends", []), friend_id)
+    return True
+
+
+def _backfill_feed(db, user_id, friend_id):
+    items = db.items.find(
+        {"user": friend_id, "public": True, "traded_in": {"$exists": False}},
+        {"user": 1, "created_at": 1},
+    )
+    items = items.sort([("created_at", -1), ("_id", -1)]).limit(FEED_BACKFILL)
+    _write(db.friend_feed, [_feed_entry(user_id, item) for item in items])
+
+
+def _add_suggestions(db, user_id, friend_ids, friend_id):
+    """
+    Counts the new paths user_id -> friend_id -> candidate and
+    follower -> user_id -> friend_id
+    """
+    known = set(friend_ids) | {user_id, friend_id}
+    friend = db.users.find_one({"_id": friend_id}, {"friends": 1}) or {}
+    increments = [
+        (user_id, candidate)
+        for candidate in friend.get("friends", [])
+        if candidate not in known
+    ]
+    for follower in db.users.find({"friends": user_id}, {"friends": 1}):
+        if follower["_id"] != friend_id and friend_id not in follower["friends"]:
+            increments.append((follower["_id"], friend_id))
+    _write(
+        db.friend_suggestions,
+        [
+            UpdateOne(
+                {"user": user, "candidate": candidate},
+                {"$inc": {"mutual": 1}},
+                upsert=True,
+            )
+            for user, candidate in increments
+        ],
+    )
+    # friend_id is a friend now, not a suggestion
+    db.friend_suggestions.delete_one({"user": user_id, "candidate": friend_id})
+
+
+def friends_page(db, friend_ids, page=0, limit=FRIENDS_PAGE_SIZE):
+    """
+    Resolves one page of a user's friends array with a single $in query, keeping the stored order.
+    Returns (friends, has_more) where friends is a list of dicts with pic, image and username.
+    """
+    start = page * limit
+    has_more = len(friend_ids) > start + limit
+    friend_ids = friend_ids[start : start + limit]
+
+    found = {
+        doc["_id"]: doc
+        for doc in db.users.find({"_id": {"$in": friend_ids}}, FRIEND_PROJECTION)
+    }
+    friends = [
+        {
+            "pic": found[friend_id]["pic"],
+            "image": found[friend_id].get("image"),
+            "username": found[friend_id]["username"],
+        }
+        for friend_id in friend_ids
+        if friend_id in found
+    ]
+    return friends, has_more
+
+
+def friends_feed(db, user_id, after=None, before=None, limit=FRIENDS_PAGE_SIZE):
+    """
+    Returns one page of the friends feed of user_id, newest first, as
+    (pagination.Page of feed entries, listings of those entries)
+    """
+    page = keyset_page(
+        db.friend_feed,
+        {"owner": ObjectId(user_id)},
+        "created_at",
+        -1,
+        projection={"item": 1, "created_at": 1},
+        after=after,
+        before=before,
+        limit=limit,
+    )
+    item_ids = [entry["item"] for entry in page.docs]
+    found = {
+        item["_id"]: item
+        for item in db.items.find(
+            {
+                "_id": {"$in": item_ids},
+                "public": True,
+                "traded_in": {"$exists": False},
+            },
+            FEED_ITEM_PROJECTION,
+        )
+    }
+    stale = [item_id for item_id in item_ids if item_id not in found]
+    if stale:
+        db.friend_feed.delete_many(
+            {"owner": ObjectId(user_id), "item": {"$in": stale}}
+        )
+    return page, [found[item_id] for item_id in item_ids if item_id in found]
+
+
+def suggestions(db, user_id, friend_ids, limit=SUGGESTIONS_SHOWN):
+    """
+    Returns the friends of friends of user_id with the most mutual friends, as dicts
+    with pic, image, username and mutual
+    """
+    # friends are taken out of the suggestions when added, this only covers races
+    known = set(friend_ids)
+    counts = [
+        suggestion
+        for suggestion in db.friend_suggestions.find(
+            {"user": ObjectId(user_id)}, {"candidate": 1, "mutual": 1}
+        )
+        .sort([("mutual", -1), ("candidate", 1)])
+        .limit(limit)
+        if suggestion["candidate"] not in known
+    ]
+    found = {
+        doc["_id"]: doc
+        for doc in db.users.find(
+            {"_id": {"$in": [suggestion["candidate"] for suggestion in counts]}},
+            FRIEND_PROJECTION,
+        )
+    }
+    return [
+        {
+            "pic": found[suggestion["candidate"]]["pic"],
+            "image": found[suggestion["candidate"]].get("image"),
+            "username": found[suggestion["candidate"]]["username"],
+            "mutual": suggestion["mutual"],
+        }
+        for suggestion in counts
+        if suggestion["candidate"] in found
+    ]
+
+
+def rebuild(db):
+    """
+    Rebuilds friend_feed and friend_suggestions from the friends arrays and items.
+    Returns (feed entries, suggestions) written.
+    """
+    friends = {
+        user["_id"]: user.get("friends", [])
+        for user in db.users.find({}, {"friends": 1})
+    }
+    db.friend_feed.delete_many({})
+    db.friend_suggestions.delete_many({})
+    suggested = 0
+    for user_id, friend_ids in friends.items():
+        for friend_id in friend_ids:
+            _backfill_feed(db, user_id, friend_id)
+        known = set(friend_ids) | {user_id}
+        mutual = Counter(
+            candidate
+            for friend_id in friend_ids
+            for candidate in friends.get(friend_id, [])
+            if candidate not in known
+        )
+        _write(
+            db.friend_suggestions,
+            [
+                UpdateOne(
+                    {"user": user_id, "candidate": candidate},
+                    {"$set": {"mutual": count}},
+                    upsert=True,
+                )
+                for candidate, count in mutual.items()
+            ],
+        )
+        suggested += len(mutual)
+    return db.friend_feed.count_documents({}), suggested
+
+
+if __name__ == "__main__":
+    from app import db
+
+    entries, suggested = rebuild(db)
+    print(" * Wrote %d feed entries and %d suggestions" % (entries, suggested))
@@ -1,8 +1,30 @@
 import pytest
-from app import app, db
-
+from app import app, db, create_app, feed_cache, metrics, user_cache
+from pagination import encode_cursor, decode_cursor, keyset_page
+from indexes import ensure_indexes
+from usercache import UserCache
+from hashing import HasherBusy, PasswordHasher
+from search import parse_price
+from cleanup import _missing_items, delete_item, sweep_orphaned_offers
+from benchmark import compare, match, percentile
+from matching import TradeGraph
+import images
+from assets import Assets, build
+from notifications import OfferNotifier
+from ratelimit import MemoryBackend, parse_rate
+from offers import OfferError, accept_offer, expire_offers, send_offer, withdraw_offer
+import profiles
+import social
+import archive
+import api
+
+import base64
 import datetime
+import io
+import threading
+import time
 from bson.objectid import ObjectId
+from bson import json_util
 from bson.decimal128 import Decimal128
 
 global USER_ID
@@ -143,6 +165,554 @@ def test_unauthorized_handler(client):
     response = client.get('/')
     assert response.status_code == 200
 
+def test_home_pages(client):
+    res = client.get('/?sort=lowest&limit=1')
+    assert res.status_code == 200
+
+def test_home_bad_cursor(client):
+    res = client.get('/?sort=oldest&after=notacursor')
+    assert res.status_code == 400
+    # a cursor smuggling query operators in as the sort value
+    token = base64.urlsafe_b64encode(json_util.dumps([{'$gt': ''}, ObjectId()]).encode()).decode()
+    assert decode_cursor(token) is None
+    assert client.get('/?sort=oldest&after=' + token).status_code == 400
+    assert client.get(api.API_PREFIX + '/feed?before=' + token).status_code == 400
+
+def test_pager_links_keep_limit(client):
+    for n in range(3):
+        db.items.insert_one({'name': 'pager 5555', 'public': True, 'price': Decimal128('1'),
+                             'created_at': datetime.datetime(2000, 1, 1, 0, 0, n)})
+    res = client.get('/?sort=oldest&limit=1')
+    link = res.get_data(as_text=True).split('Next')[0].rsplit('href="', 1)[1].split('"')[0]
+    assert 'limit=1' in link
+    # the links carry the page size used, not whatever the first visitor sent
+    after = link.split('after=')[1].split('&')[0]
+    res = client.get(f'/?sort=oldest&after={after}&limit=abc')
+    link = res.get_data(as_text=True).split('Previous')[0].rsplit('href="', 1)[1]
+    assert 'limit=24' in link and 'abc' not in link
+    db.items.delete_many({'name': 'pager 5555'})
+
+def test_cursor_round_trip():
+    doc = {'_id': ObjectId(), 'price': Decimal128('5.50')}
+    assert decode_cursor(encode_cursor(doc, 'price')) == (doc['price'], doc['_id'])
+
+def test_ensure_indexes():
+    ensure_indexes(db)
+    assert 'username_unique' in db.users.index_information()
+    assert 'public_created_at' in db.items.index_information()
+    assert 'sendtouser_id' in db.offers.index_information()
+    assert 'sentby_status_id' in db.offers.index_information()
+    assert 'status_updated_at' in db.offers.index_information()
+    assert 'public_updated_at' in db.items.index_information()
+
+def test_friends(client, user, login):
+    res = client.get('/friends?page=1')
+    assert res.status_code == 200
+
+def test_sent_offers_page(client, user, login):
+    res = client.get('/sentoffers?status=accepted')
+    assert res.status_code == 200
+
+def test_recieved_offers_page(client, user, login):
+    res = client.get('/recievedoffers?limit=5')
+    assert res.status_code == 200
+
+def test_user_cache(client, user):
+    cache = UserCache(db, ttl=60, maxsize=1)
+    found = cache.get_by_username('marc3')
+    assert found['_id'] == USER_ID
+    assert 'password' not in found
+    assert cache.get(USER_ID) is found
+    cache.invalidate(USER_ID)
+    assert cache.get(USER_ID) is not found
+    cache.get(ObjectId())
+    assert len(cache._docs) == 1
+
+def test_password_hasher():
+    hasher = PasswordHasher(rounds=4, workers=1, queue_size=0)
+    hashed = hasher.hash('password')
+    assert hasher.verify(hashed, 'password')
+    assert not hasher.verify(hashed, 'assword')
+    assert hasher.stats['verify'].count == 2
+
+def test_password_hasher_busy():
+    hasher = PasswordHasher(rounds=4, workers=1, queue_size=0)
+    hasher._slots.acquire()
+    with pytest.raises(HasherBusy):
+        hasher.hash('password')
+    assert hasher.stats['hash'].rejected == 1
+
+def test_create_app():
+    other = create_app({'TESTING': True})
+    assert other is not app
+    with other.test_client() as other_client:
+        assert other_client.get('/login').status_code == 200
+
+def test_ready(client):
+    res = client.get('/ready')
+    assert res.status_code == 200
+    assert res.json['status'] == 'ok'
+
+def test_parse_price():
+    assert parse_price('12.50') == Decimal128('12.50')
+    assert parse_price('abc') is None
+    assert parse_price('-1') is None
+    assert parse_price('') is None
+
+def test_search(client):
+    ensure_indexes(db)
+    res = client.get('/search?q=5555&min=1&max=1000')
+    assert res.status_code == 200
+
+def test_home_not_modified(client):
+    res = client.get('/?sort=highest')
+    etag = res.headers['ETag']
+    res = client.get('/?sort=highest', headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    feed_cache.invalidate()
+    res = client.get('/?sort=highest', headers={'If-None-Match': etag})
+    assert res.status_code == 200
+
+def test_sweep_orphaned_offers():
+    offer_id = db.offers.insert_one({'offerforid': str(ObjectId()), 'offereditems': [], 'status': 'sent'}).inserted_id
+    assert sweep_orphaned_offers(db) >= 1
+    assert db.offers.find_one({'_id': offer_id}) is None
+
+def test_delete_item_cascades():
+    item_id = db.items.insert_one({'name': 'cascade test', 'public': False}).inserted_id
+    offer_id = db.offers.insert_one({'offerforid': str(item_id), 'offereditems': [], 'status': 'sent'}).inserted_id
+    assert delete_item(db, str(item_id)) == (1, 1)
+    assert db.offers.find_one({'_id': offer_id}) is None
+
+def test_import_export(client, user, login):
+    rows = b'name,description,price,image_url\nbulk 5555,d,5,u\n,missing name,5,u\n'
+    res = client.post('/import?format=csv', data=rows, content_type='text/csv')
+    assert res.json['inserted'] == 1
+    assert res.json['errors'] == [{'row': 2, 'error': 'name is required'}]
+    res = client.get('/export/csv')
+    assert 'bulk 5555' in res.get_data(as_text=True)
+    db.items.delete_many({'name': 'bulk 5555'})
+
+def test_metrics(client):
+    client.get('/login')
+    res = client.get('/metrics')
+    assert res.status_code == 200
+    body = res.get_data(as_text=True)
+    assert 'http_requests_total{route="/login",method="GET",status="200"}' in body
+    assert 'password_hash_calls' in body
+
+def test_benchmark_percentiles():
+    latencies = [i / 1000 for i in range(1, 101)]
+    assert percentile(latencies, 50) == 0.05
+    assert percentile(latencies, 99) == 0.099
+    assert percentile([], 95) == 0.0
+    baseline = {'/': {'p95_ms': 10.0}}
+    assert compare({'/': {'p95_ms': 12.0}}, baseline) == []
+    assert len(compare({'/': {'p95_ms': 13.0}}, baseline)) == 1
+
+def test_image_upload(client, user, login):
+    from PIL import Image
+    upload = io.BytesIO()
+    Image.new('RGB', (1600, 900), 'red').save(upload, 'PNG')
+    upload.seek(0)
+    data = dict(TEST_ITEM_POST, itemname='image 5555', url='', image=(upload, 'red.png'))
+    client.post(f"/add/{str(USER_ID)}", data=data, content_type='multipart/form-data')
+    # the background worker may get to the image first
+    for _ in range(50):
+        item = db.items.find_one({'name': 'image 5555'})
+        if item.get('image'):
+            break
+        images.process_next(db.operation('default'))
+        time.sleep(0.1)
+    res = client.get(f"/images/{item['image']['thumb']}")
+    assert res.status_code == 200
+    assert 'immutable' in res.headers['Cache-Control']
+    assert max(Image.open(io.BytesIO(res.data)).size) == images.RENDITIONS['thumb']
+    res = client.get(f"/images/{item['image']['thumb']}", headers={'If-None-Match': res.headers['ETag']})
+    assert res.status_code == 304
+    assert client.get('/images/original').status_code == 404
+    db.items.delete_many({'name': 'image 5555'})
+
+def test_static_assets(tmp_path):
+    from PIL import Image
+    from flask import url_for
+    (tmp_path / 'style.css').write_text('body { color: red; }\n' * 100)
+    Image.new('RGB', (40, 40), 'blue').save(tmp_path / 'user.png')
+    manifest = build(str(tmp_path))
+    assert manifest['user.png']['webp'].endswith('.webp')
+    other = create_app({'TESTING': True})
+    Assets(str(tmp_path)).init_app(other)
+    with other.test_request_context():
+        url = url_for('static', filename='style.css')
+    assert url == '/static/dist/' + manifest['style.css']['path']
+    with other.test_client() as other_client:
+        res = other_client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert res.status_code == 200
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert 'immutable' in res.headers['Cache-Control']
+        res = other_client.get(url, headers={'If-None-Match': res.headers['ETag']})
+        assert res.status_code == 304
+
+def test_offer_notifications():
+    notifier = OfferNotifier(db, max_subscribers=2)
+    owner, sender = ObjectId(), ObjectId()
+    owner_events = notifier.subscribe(owner)
+    sender_events = notifier.subscribe(sender)
+    assert notifier.subscribe(ObjectId()) is None
+    offer = {'_id': ObjectId(), 'offerforid': 'item', 'sentby': sender, 'sendtouser': owner, 'status': 'sent'}
+    notifier.publish(offer)
+    assert owner_events.get_nowait() == ('new_offer', {'offer': str(offer['_id']), 'offerforid': 'item', 'status': 'sent'})
+    assert sender_events.empty()
+    notifier.publish(dict(offer, status='accepted'))
+    assert sender_events.get_nowait()[0] == 'acceptoffer'
+    assert owner_events.empty()
+    notifier.unsubscribe(owner, owner_events)
+    notifier.unsubscribe(sender, sender_events)
+
+def test_profile_stats(client, user):
+    client.post('/signup', data={'fusername': 'stats5555', 'fpassword': 'password'})
+    client.post('/login', data={'fusername': 'stats5555', 'fpassword': 'password'})
+    user_id = db.users.find_one({'username': 'stats5555'})['_id']
+    client.post(f"/add/{str(user_id)}", data=dict(TEST_ITEM_POST, itemname='stats 5555'))
+    item_id = db.items.find_one({'name': 'stats 5555'})['_id']
+    assert profiles.user_stats(db, user_id)['listings'] == 1
+    # the profile pages are streamed, close them before the next request
+    with client.get('/profile') as res:
+        assert 'stats 5555' in res.get_data(as_text=True)
+    client.post('/login', data=TEST_USER_POST)
+    with client.get('/viewUser/stats5555') as res:
+        assert 'stats 5555' in res.get_data(as_text=True)
+    client.post('/login', data={'fusername': 'stats5555', 'fpassword': 'password'})
+    client.get(f"/setprivate/{str(item_id)}")
+    client.get(f"/setprivate/{str(item_id)}")
+    assert profiles.user_stats(db, user_id)['public'] == 0
+    assert client.get('/profile').status_code == 200
+    client.get(f"/delete/{str(item_id)}")
+    stats = profiles.user_stats(db, user_id)
+    assert stats == profiles.recount(db, user_id)
+    assert stats['listings'] == 0
+    db.users.delete_one({'_id': user_id})
+
+def test_offer_lifecycle():
+    owner, first, second = ObjectId(), ObjectId(), ObjectId()
+    wanted, mine, theirs = (
+        str(db.items.insert_one({'name': 'lifecycle', 'user': user_id, 'public': True}).inserted_id)
+        for user_id in (owner, first, second)
+    )
+    offer = send_offer(db, wanted, [mine], first)
+    competing = send_offer(db, wanted, [theirs], second)
+    with pytest.raises(OfferError):
+        accept_offer(db, offer['_id'], first)
+    accept_offer(db, offer['_id'], owner)
+    assert db.offers.find_one({'_id': competing['_id']})['status'] == 'rejected'
+    traded = db.items.find({'_id': {'$in': [ObjectId(wanted), ObjectId(mine)]}})
+    assert all(item['traded_in'] == offer['_id'] and not item['public'] for item in traded)
+    with pytest.raises(OfferError):
+        withdraw_offer(db, competing['_id'], second)
+    with pytest.raises(OfferError):
+        send_offer(db, wanted, [theirs], second)
+    db.items.delete_many({'name': 'lifecycle'})
+    db.offers.delete_many({'_id': {'$in': [offer['_id'], competing['_id']]}})
+
+def test_rate_limit():
+    backend, rate = MemoryBackend(), parse_rate('2/10')
+    assert [backend.take('bucket', rate, now=0) for _ in range(3)] == [0, 0, 5]
+    assert backend.take('bucket', rate, now=5) == 0
+    limited = create_app({'TESTING': True, 'RATELIMIT_ENABLED': True}).test_client()
+    form = {'fusername': 'ratelimit5555', 'fpassword': 'password'}
+    env = {'REMOTE_ADDR': '203.0.113.9'}
+    codes = [limited.post('/login', data=form, environ_base=env).status_code for _ in range(6)]
+    assert codes[:5] == [200] * 5 and codes[5] == 429
+    res = limited.post('/login', data=form, environ_base=env)
+    assert int(res.headers['Retry-After']) > 0
+    assert limited.get('/login', environ_base=env).status_code == 200
+
+def test_streamed_pages(client, user, login):
+    query = {'name': 'streamed 5555'}
+    db.items.insert_many([dict(query, created_at=datetime.datetime(2001, 1, 1, 0, 0, n)) for n in range(5)])
+    after = None
+    for _ in range(3):
+        whole = keyset_page(db.items, query, 'created_at', -1, after=after, limit=2)
+        streamed = keyset_page(db.items, query, 'created_at', -1, after=after, limit=2, stream=True)
+        assert list(streamed.docs) == whole.docs
+        assert (streamed.next_cursor, streamed.prev_cursor) == (whole.next_cursor, whole.prev_cursor)
+        after = whole.next_cursor
+    assert after is None
+    res = client.get('/viewListings')
+    assert res.is_streamed and res.status_code == 200
+    db.items.delete_many(query)
+
+def test_trade_rings(client, user, login):
+    ring = [('a', 'ann', 'b', 'bob'), ('b', 'bob', 'c', 'cat'), ('c', 'cat', 'a', 'ann')]
+    offers = [{'_id': n, 'status': 'sent', 'offereditems': [have], 'sentby': sender, 'offerforid': want, 'sendtouser': owner}
+              for n, (have, sender, want, owner) in enumerate(ring)]
+    graph = TradeGraph(3)
+    assert [graph.add_offer(offer) for offer in offers] == [0, 0, 1]
+    assert [sorted(cycle) for cycle in graph.cycles_for('ann')] == [[('a', 'ann'), ('b', 'bob'), ('c', 'cat')]]
+    graph.apply(dict(offers[1], status='rejected'))
+    assert graph.cycles_for('ann') == []
+    # items and users no pending offer mentions are forgotten, their numbers reused
+    graph.apply(dict(offers[0], status='deleted'))
+    assert graph.item_count() == 2 and graph.cycles_for('bob') == []
+    graph.apply(dict(offers[2], status='accepted'))
+    assert graph.item_count() == 0 and len(graph) == 0
+    for offer in offers:
+        graph.add_offer(offer, search=False)
+    assert graph.match() == 1 and len(graph._items) == 3 and len(graph._users) == 3
+    assert TradeGraph(3).load(offers) == 1 and TradeGraph(2).load(offers) == 0
+    assert match(offers=2000, users=50, added=10)['offers'] == 2000
+    assert client.get('/trades').status_code == 200
+
+def test_json_api(client, user):
+    feed = client.get('/api/v1/feed?sort=lowest&limit=2')
+    assert feed.status_code == 200 and feed.json['sort'] == 'lowest' and len(feed.json['items']) <= 2
+    assert client.get('/api/v1/friends').status_code == 401
+    client.post('/login', data = TEST_USER_POST)
+    assert client.get('/api/v1/friends').json['friends'] == []
+    assert client.get('/api/v1/users/marc3').json['user']['username'] == 'marc3'
+    assert client.get('/api/v1/offers/sent').json['items'] == []
+    assert client.get('/api/v1/offers/other').status_code == 404
+    assert client.get('/api/v1/items/nope').status_code == 404
+
+def test_friends_feed(client, user, login):
+    ann, bob, cat = [db.users.insert_one({'username': name, 'pic': '', 'friends': []}).inserted_id for name in ('fann', 'fbob', 'fcat')]
+    lamp = {'name': 'flamp', 'user': bob, 'public': True, 'created_at': datetime.datetime.utcnow()}
+    db.items.insert_one(lamp)
+    assert social.add_friend(db, ann, bob) and not social.add_friend(db, ann, bob)
+    assert [doc['name'] for doc in social.friends_feed(db, ann)[1]] == ['flamp']
+    social.add_friend(db, bob, cat)
+    assert [(s['username'], s['mutual']) for s in social.suggestions(db, ann, [bob])] == [('fcat', 1)]
+    desk = {'name': 'fdesk', 'user': bob, 'public': True, 'created_at': datetime.datetime.utcnow()}
+    db.items.insert_one(desk)
+    social.publish_items(db, [desk])
+    assert [doc['name'] for doc in social.friends_feed(db, ann)[1]] == ['fdesk', 'flamp']
+    social.unpublish_items(db, [lamp['_id']])
+    assert [doc['name'] for doc in social.friends_feed(db, ann)[1]] == ['fdesk']
+    bike = {'name': 'fbike', 'user': cat, 'public': True, 'created_at': datetime.datetime.utcnow()}
+    db.items.insert_one(bike)
+    social.publish_items(db, [bike])
+    assert [doc['name'] for doc in social.friends_feed(db, bob)[1]] == ['fbike']
+    assert [doc['name'] for doc in social.friends_feed(db, ann)[1]] == ['fdesk']
+    assert client.get('/friendsfeed').status_code == 200 and client.get('/friends').status_code == 200
+    db.items.delete_many({'user': {'$in': [bob, cat]}})
+    db.users.delete_many({'_id': {'$in': [ann, bob, cat]}})
+    db.friend_feed.delete_many({'owner': {'$in': [ann, bob, cat]}})
+    db.friend_suggestions.delete_many({'user': {'$in': [ann, bob, cat]}})
+
+def test_archive(client, user, login):
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=400)
+    kept, stale, wanted = [db.items.insert_one({'name': name, 'user': USER_ID, 'public': False, 'updated_at': old, 'created_at': old}).inserted_id for name in ('akept', 'astale', 'awanted')]
+    pending, resolved = db.offers.insert_many([
+        {'status': 'sent', 'offerforid': str(kept), 'offereditems': [], 'sentby': USER_ID},
+        {'status': 'rejected', 'offerforid': str(wanted), 'offereditems': [str(stale)], 'sentby': USER_ID, 'sendtouser': USER_ID, 'updated_at': old},
+    ]).inserted_ids
+    items = {'_id': {'$in': [kept, stale, wanted]}}
+    offers = {'_id': {'$in': [pending, resolved]}}
+    assert archive.archive_offers(db, datetime.timedelta(days=30), batch_size=1, query=offers) == 1
+    assert archive.archive_items(db, datetime.timedelta(days=180), batch_size=1, query=items) == 2
+    assert db.offers.find_one({'_id': pending}) and not db.offers.find_one({'_id': resolved})
+    assert db.items.find_one({'_id': kept}) and not db.items.find_one({'_id': stale})
+    history = archive.offer_history(db, USER_ID)
+    assert [offer['offerforid']['name'] for offer in history.docs] == ['awanted']
+    assert _missing_items(db, {str(stale), str(wanted)}) == set()
+    assert client.get('/history').status_code == 200 and client.get('/history/listings').status_code == 200
+    assert archive.restore_item(db, stale, USER_ID) and db.items.find_one({'_id': stale})
+    db.offers.delete_many(offers)
+    db.items.delete_many(items)
+    db.offers_archive.delete_many(offers)
+    db.items_archive.delete_many(items)
+
+def test_json_api_item_offers(client, user, login):
+    wanted = str(db.items.insert_one({'name': 'apiwanted', 'user': ObjectId(), 'public': True}).inserted_id)
+    mine = str(db.items.insert_one({'name': 'apimine', 'user': USER_ID, 'public': True}).inserted_id)
+    offer = send_offer(db, wanted, [mine], USER_ID)
+    body = client.get('/api/v1/items/' + wanted).json
+    assert body['item']['name'] == 'apiwanted'
+    assert body['offers'] == [{'id': str(offer['_id']), 'offereditems': [mine]}]
+    db.offers.delete_one({'_id': offer['_id']})
+    db.items.delete_many({'name': {'$in': ['apiwanted', 'apimine']}})
+
+def test_streamed_page_metrics(client, user, login):
+    before = metrics._render['/viewListings']
+    requests = sum(count for (route, _, _), count in metrics._requests.items() if route == '/viewListings')
+    res = client.get('/viewListings')
+    assert res.is_streamed
+    res.get_data()
+    res.close()
+    assert metrics._render['/viewListings'] > before
+    assert sum(count for (route, _, _), count in metrics._requests.items() if route == '/viewListings') == requests + 1
+
+def test_polled_offer_deletions():
+    notifier = OfferNotifier(db, poll_interval=0.05)
+    seen = []
+    notifier.add_listener(seen.append)
+    threading.Thread(target=notifier._poll, daemon=True).start()
+    time.sleep(0.1)
+    owner, sender = ObjectId(), ObjectId()
+    wanted = str(db.items.insert_one({'name': 'polled', 'user': owner, 'public': True}).inserted_id)
+    mine = str(db.items.insert_one({'name': 'polled', 'user': sender, 'public': True}).inserted_id)
+    offer = send_offer(db, wanted, [mine], sender)
+    delete_item(db, wanted)
+    deadline = time.monotonic() + 2
+    # other tests' deletions can be polled too, and the sent and deleted events
+    # of this offer can come in the same poll in either order
+    deleted = lambda: [event for event in seen if event.get('status') == 'deleted' and event['_id'] == offer['_id']]
+    while time.monotonic() < deadline and not deleted():
+        time.sleep(0.05)
+    assert deleted()
+    db.items.delete_many({'name': 'polled'})
+    db.offer_deletions.delete_one({'_id': offer['_id']})
+
+def test_deleteoffer_withdraws_pending(client, user, login):
+    wanted = str(db.items.insert_one({'name': 'editoffer', 'user': ObjectId(), 'public': True}).inserted_id)
+    mine = str(db.items.insert_one({'name': 'editoffer', 'user': USER_ID, 'public': True}).inserted_id)
+    offer = send_offer(db, wanted, [mine], USER_ID)
+    res = client.get('/deleteoffer/%s' % offer['_id'])
+    assert res.status_code == 302 and res.location.endswith('/offer/' + wanted)
+    assert db.offers.find_one({'_id': offer['_id']})['status'] == 'withdrawn'
+    client.get('/deleteoffer/%s' % offer['_id'])
+    assert db.offers.find_one({'_id': offer['_id']}) is None
+    db.items.delete_many({'name': 'editoffer'})
+
+
+def test_image_url_private_addresses():
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from PIL import Image
+    with pytest.raises(ValueError):
+        images.add_url(db.operation('default'), 'http://169.254.169.254/latest/meta-data')
+    requests = []
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            self.send_response(200)
+            self.end_headers()
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        # a host name resolving to loopback is refused before connecting
+        with pytest.raises(ValueError):
+            images._fetch(f"http://localhost:{server.server_port}/x.png")
+    finally:
+        server.shutdown()
+    assert requests == []
+    bomb = io.BytesIO()
+    Image.new('1', (8000, 8000)).save(bomb, 'PNG')
+    with pytest.warns(Image.DecompressionBombWarning), pytest.raises(ValueError):
+        images.render(bomb.getvalue(), images.RENDITIONS['thumb'])
+
+
+def test_hasher_timeout_keeps_slot():
+    hasher = PasswordHasher(rounds=4, workers=1, queue_size=1, timeout=0.05)
+    with pytest.raises(HasherBusy):
+        hasher._run('hash', time.sleep, 0.3)
+    # the sleep still runs and holds its slot, the call queued behind it is
+    # cancelled on timeout and gives its slot back
+    with pytest.raises(HasherBusy):
+        hasher._run('hash', time.sleep, 0.3)
+    assert hasher._slots._value == 1
+    assert hasher.stats['hash'].rejected == 2
+    time.sleep(0.4)
+    assert hasher._slots._value == 2
+    assert hasher.verify(hasher.hash('password'), 'password')
+    hasher.shutdown()
+
+
+def test_signup_race(client, monkeypatch):
+    ensure_indexes(db)
+    client.post('/signup', data={'fusername': 'race5555', 'fpassword': 'password'})
+    # the other request inserted the user after this one looked it up
+    monkeypatch.setattr(user_cache, 'get_by_username', lambda username: None)
+    res = client.post('/signup', data={'fusername': 'race5555', 'fpassword': 'password'})
+    assert res.status_code == 200
+    assert 'Username already in use.' in str(res.data)
+    assert db.users.count_documents({'username': 'race5555'}) == 1
+    db.users.delete_many({'username': 'race5555'})
+
+
+def test_import_unreadable_tail(client, user, login):
+    follower = db.users.insert_one({'username': 'follower5555', 'friends': [USER_ID]}).inserted_id
+    # TextIOWrapper decodes in chunks, so the bad bytes must come after the first one
+    rows = b'name,price\n' + b'partial 5555,5\n' * 1000 + b'\xff\xfe,5\n'
+    res = client.post('/import?format=csv', data=rows, content_type='text/csv')
+    assert res.status_code == 400
+    assert res.json['error'].startswith('could not read the file')
+    assert 0 < res.json['inserted'] < 1000
+    assert db.items.count_documents({'name': 'partial 5555'}) == res.json['inserted']
+    assert db.friend_feed.count_documents({'owner': follower}) == res.json['inserted']
+    assert db.users.find_one({'_id': USER_ID})['stats']['listings'] >= res.json['inserted']
+    db.items.delete_many({'name': 'partial 5555'})
+    db.friend_feed.delete_many({'owner': follower})
+    db.users.delete_one({'_id': follower})
+
+
+def test_shared_user_cache(client, user):
+    class DictBackend(dict):
+        def set(self, key, value, ttl):
+            self[key] = value
+        def delete(self, *keys):
+            for key in keys:
+                self.pop(key, None)
+    shared = DictBackend()
+    # two workers sharing one backend
+    first, second = UserCache(db, shared=shared), UserCache(db, shared=shared)
+    assert second.get_by_username('marc3')['_id'] == USER_ID
+    db.users.update_one({'_id': USER_ID}, {'$set': {'bio': 'shared 5555'}})
+    first.invalidate(username='marc3')
+    assert second.get(USER_ID)['bio'] == 'shared 5555'
+    assert second.get_by_username('marc3')['bio'] == 'shared 5555'
+    assert not second._docs
+    db.users.update_one({'_id': USER_ID}, {'$set': {'bio': ''}})
+    first.invalidate(USER_ID)
+
+
+def test_expire_offers_counts_changed_only():
+    recipient = db.users.insert_one({'username': 'expire5555', 'stats': profiles.empty_stats()}).inserted_id
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=10)
+    ids = [ObjectId.from_datetime(old + datetime.timedelta(seconds=n)) for n in range(2)]
+    db.offers.insert_many([{'_id': offer_id, 'status': 'sent', 'sendtouser': recipient} for offer_id in ids])
+    profiles.adjust(db, recipient, offers_pending=2)
+
+    class Answering:
+        # accepts the second offer after expire_offers has found it
+        def __init__(self, db):
+            self.db = db
+        def __getattr__(self, name):
+            return getattr(self.db, name)
+        @property
+        def offers(self):
+            offers = self.db.offers
+            class Offers:
+                def __getattr__(self, name):
+                    return getattr(offers, name)
+                def find(self, *args, **kwargs):
+                    found = list(offers.find(*args, **kwargs))
+                    offers.update_one({'_id': ids[1]}, {'$set': {'status': 'accepted'}})
+                    profiles.adjust(db, recipient, offers_pending=-1)
+                    return found
+            return Offers()
+
+    assert expire_offers(Answering(db), datetime.timedelta(days=1)) == 1
+    assert db.offers.find_one({'_id': ids[0]})['status'] == 'expired'
+    assert db.offers.find_one({'_id': ids[1]})['status'] == 'accepted'
+    assert profiles.user_stats(db, recipient)['offers_pending'] == 0
+    db.offers.delete_many({'_id': {'$in': ids}})
+    db.users.delete_one({'_id': recipient})
+
+
+def test_sweep_repairs_pending_counters():
+    over, under = [db.users.insert_one({'username': name, 'stats': profiles.empty_stats()}).inserted_id
+                   for name in ('over5555', 'under5555')]
+    profiles.adjust(db, over, offers_pending=3)
+    offer_ids = db.offers.insert_many([
+        {'status': 'sent', 'sendtouser': over, 'offerforid': 'x', 'offereditems': []},
+        {'status': 'sent', 'sendtouser': under, 'offerforid': 'x', 'offereditems': []},
+    ]).inserted_ids
+    assert profiles.repair_pending(db) >= 2
+    assert profiles.user_stats(db, over)['offers_pending'] == 1
+    assert profiles.user_stats(db, under)['offers_pending'] == 1
+    db.offers.delete_many({'_id': {'$in': offer_ids}})
+    db.users.delete_many({'_id': {'$in': [over, under]}})
+
 db.users.delete_one(TEST_USER_MONGO)
 db.items.delete_one(TEST_ITEM_MONGO)
 pytest.main()
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""
+Process-local cache of user documents.
+
+Every request that touches current_user loads the user through user_loader,
+and many routes then look the same user up again. UserCache keeps recently
+used user documents in memory for a short time so those lookups usually do not
+reach MongoDB at all.
+
+Entries expire after ttl seconds and the least recently used entries are
+dropped once there are more than maxsize of them. Each web worker has its own
+cache, so a write in one worker is only seen by the others once their entry
+expires. Pass a shared backend (for example RedisBackend) to keep all workers
+in step: the entries then live only in the backend, so an invalidate() in one
+worker is seen by all of them straight away. Writes must call invalidate()
+either way.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import bson
+from bson.objectid import ObjectId
+
+# never keep password hashes around, log_in reads them from the database
+USER_PROJECTION = {"password": 0}
+
+
+class RedisBackend:
+    """
+    Shared cache backend that stores entries in Redis.
+    Needs the redis package, which is not in requirements.txt.
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=ttl)
+
+    def delete(self, *keys):
+        self.client.delete(*keys)
+
+
+class UserCache:
+    """
+    TTL and LRU bounded cache of user documents keyed by _id, with lookups by username.
+    """
+
+    def __init__(self, db, ttl=60, maxsize=1024, shared=None):
+        self.db = db
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.shared = shared
+        self._docs = OrderedDict()  # id string -> (expires at, user document)
+        self._ids = {}  # username -> id string
+        self._lock = threading.Lock()
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._docs.get(key)
+            if entry is None:
+                return None
+            expires, doc = entry
+            if expires < time.monotonic():
+                del self._docs[key]
+                self._ids.pop(doc["username"], None)
+                return None
+            self._docs.move_to_end(key)
+            return doc
+
+    def _put_local(self, doc):
+        key = str(doc["_id"])
+        with self._lock:
+            self._docs[key] = (time.monotonic() + self.ttl, doc)
+            self._docs.move_to_end(key)
+            self._ids[doc["username"]] = key
+            while len(self._docs) > self.maxsize:
+                _, (_, dropped) = self._docs.popitem(last=False)
+                if self._ids.get(dropped["username"]) == str(dropped["_id"]):
+                    del self._ids[dropped["username"]]
+
+    def _get_shared(self, key):
+        if self.shared is None:
+            return None
+        raw = self.shared.get("user:" + key)
+        if raw is None:
+            return None
+        return bson.decode(raw)
+
+    def _get_cached(self, key):
+        # a local copy could outlive an invalidate() in another worker, so with
+        # a shared backend nothing is kept locally
+        if self.shared is not None:
+            return self._get_shared(key)
+        return self._get_local(key)
+
+    def _store(self, doc):
+        if self.shared is None:
+            self._put_local(doc)
+        else:
+            key = str(doc["_id"])
+            self.shared.set("user:" + key, bson.encode(doc), self.ttl)
+            self.shared.set("username:" + doc["username"], key, self.ttl)
+        return doc
+
+    def get(self, user_id):
+        """
+        Returns the user document with the given _id, or None if there is no such user
+        """
+        key = str(user_id)
+        doc = self._get_cached(key)
+        if doc is not None:
+            return doc
+        doc = self.db.users.find_one({"_id": ObjectId(key)}, USER_PROJECTION)
+        return self._store(doc) if doc else None
+
+    def get_by_username(self, username):
+        """
+        Returns the user document with the given username, or None if there is no such user
+        """
+        if self.shared is not None:
+            raw = self.shared.get("username:" + username)
+            key = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+        else:
+            with self._lock:
+                key = self._ids.get(username)
+        if key is not None:
+            doc = self._get_cached(key)
+            if doc is not None and doc["username"] == username:
+                return doc
+        doc = self.db.users.find_one({"username": username}, USER_PROJECTION)
+        return self._store(doc) if doc else None
+
+    def invalidate(self, user_id=None, username=None):
+        """
+        Drops a user from the cache. Call this after every write to a user document.
+        """
+        keys = []
+        if username is not None and user_id is None and self.shared is not None:
+            raw = self.shared.get("username:" + username)
+            user_id = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+        with self._lock:
+            if username is not None and user_id is None:
+                user_id = self._ids.get(username)
+            if user_id is not None:
+                entry = self._docs.pop(str(user_id), None)
+                keys.append("user:" + str(user_id))
+                if entry is not None:
+                    username = username or entry[1]["username"]
+            if username is not None:
+                self._ids.pop(username, None)
+                keys.append("username:" + username)
+        if self.shared is not None and keys:
+            self.shared.delete(*keys)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+            self._ids.clear()
+
+
+def user_cache_from_env(db):
+    """
+    Builds a UserCache configured by USER_CACHE_TTL, USER_CACHE_SIZE and USER_CACHE_REDIS_URL
+    """
+    redis_url = os.getenv("USER_CACHE_REDIS_URL")
+    return UserCache(
+        db,
+        ttl=int(os.getenv("USER_CACHE_TTL", "60")),
+        maxsize=int(os.getenv("USER_CACHE_SIZE", "1024")),
+        shared=RedisBackend(redis_url) if redis_url else None,
+    )